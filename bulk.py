@@ -0,0 +1,155 @@
+#! python3
+import csv
+import datetime
+import io
+import itertools
+import json
+
+import handle
+import model
+
+FIELDS = {
+    "sleep": (model.Sleep, ("date", "amount")),
+    "out": (model.Out, ("date", "amount")),
+    "birthday": (model.Birthday, ("date", "text")),
+    "period": (model.Period, ("idate", "fdate", "text")),
+}
+VERSION_NAMES = {"sleep": "sleep", "out": "out",
+                 "birthday": "calendar", "period": "calendar"}
+CONTENT_TYPES = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+CHUNK_SIZE = 500  # Rows per query or transaction
+# Values of a smallint column, -32768 is left out as it marks the missing
+# days of a series.DaySeries
+SMALL_INTEGERS = range(-32767, 32768)
+
+
+def parse(correct_model, row):
+    """
+    Convert the values of a CSV/JSONL row to the types of its model fields
+
+    :raises ValueError: If a value does not fit its field
+    """
+    values = {}
+    for name, value in row.items():
+        field = correct_model._meta.fields[name]
+        if isinstance(field, model.pw.DateField):
+            value = datetime.date(*map(int, str(value).split("-")))
+        elif isinstance(field, model.pw.IntegerField):
+            value = int(value)
+            if (isinstance(field, model.pw.SmallIntegerField) and
+                    value not in SMALL_INTEGERS):
+                raise ValueError(f"{name} {value} out of range")
+        values[name] = value
+    return values
+
+
+def read_rows(kind, fmt, lines):
+    """
+    Parse CSV (with header) or JSONL lines into dictionaries of values
+    """
+    correct_model, fields = FIELDS[kind]
+    if fmt == "csv":
+        rows = csv.DictReader(lines)
+    else:
+        rows = (json.loads(line) for line in lines if line.strip())
+    for row in rows:
+        yield parse(correct_model, {i: row[i] for i in fields})
+
+
+def _insert_chunk(kind, rows):
+    correct_model, fields = FIELDS[kind]
+    if kind == "period":  # No natural key, replace the same dates instead
+        rows = list({(row["idate"], row["fdate"]): row
+                     for row in rows}.values())
+        for row in rows:
+            (correct_model.delete()
+             .where(correct_model.idate == row["idate"],
+                    correct_model.fdate == row["fdate"])
+             .execute())
+        correct_model.insert_many(rows).execute()
+        return
+    key = correct_model._meta.primary_key
+    # A key may only appear once per statement, the last row wins as it
+    # does between chunks
+    rows = list({row[key.name]: row for row in rows}.values())
+    (correct_model
+     .insert_many(rows)
+     .on_conflict(conflict_target=[key],
+                  preserve=[correct_model._meta.fields[i] for i in fields
+                            if i != key.name])
+     .execute())
+    if kind in model.AMOUNT_MODELS:
+        for week in set(handle.date_week(row["date"]) for row in rows):
+            model.refresh_week(kind, week)
+
+
+def ingest(kind, fmt, lines):
+    """
+    Upsert every row in chunks of :const:`CHUNK_SIZE`, each in its own
+    transaction. A row repeating a key replaces the previous one
+
+    :param str kind: Key of :const:`FIELDS`
+    :param str fmt: csv or jsonl
+    :param lines: Iterable of text lines
+
+    :return: Number of rows
+    :rtype: int
+    """
+    rows = read_rows(kind, fmt, lines)
+    total = 0
+    try:
+        while True:
+            chunk = list(itertools.islice(rows, CHUNK_SIZE))
+            if not chunk:
+                break
+            with model.db.atomic():
+                _insert_chunk(kind, chunk)
+                model.bump_version(VERSION_NAMES[kind])
+            total += len(chunk)
+    finally:
+        if total:  # Even if a later chunk failed
+            handle.notify_change(VERSION_NAMES[kind])
+    return total
+
+
+def _format_value(value):
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+
+def export(kind, fmt):
+    """
+    Yield every row encoded as CSV (with header) or JSONL, reading the
+    table in chunks of :const:`CHUNK_SIZE` rows ordered by primary key
+
+    :param str kind: Key of :const:`FIELDS`
+    :param str fmt: csv or jsonl
+
+    :rtype: generator of bytes
+    """
+    correct_model, fields = FIELDS[kind]
+    key = correct_model._meta.primary_key
+    columns = [correct_model._meta.fields[i] for i in fields]
+    if fmt == "csv":
+        yield (",".join(fields) + "\r\n").encode()
+    last = None
+    while True:
+        with model.db.connection_context():
+            query = correct_model.select(key, *columns).order_by(key)
+            if last is not None:
+                query = query.where(key > last)
+            chunk = list(query.limit(CHUNK_SIZE).tuples())
+        if not chunk:
+            break
+        last = chunk[-1][0]
+        buffer = io.StringIO()
+        if fmt == "csv":
+            writer = csv.writer(buffer)
+            for row in chunk:
+                writer.writerow([_format_value(i) for i in row[1:]])
+        else:
+            for row in chunk:
+                values = dict(zip(fields, map(_format_value, row[1:])))
+                buffer.write(json.dumps(values) + "\n")
+        yield buffer.getvalue().encode()
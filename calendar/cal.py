@@ -1,18 +1,40 @@
 #! python3
+import collections
 import datetime
 import json
 import os
 
 import common
+import interval
+import series
 
 CURRENT_DIR = os.path.dirname(__file__)
 YEAR = datetime.date.today().year
 GIFT_PNG = common.pg_load(os.path.join(CURRENT_DIR, "images", "gift.png"))
-SIZE = common.A4[150]
-WIDTH, EXTRA_WIDTH = divmod(SIZE[0], 7)
-HEADER_HEIGHT = SIZE[1] // 35
 BIRTHDAY_FONT_NAME = common.FONT1
 TEXT_FONT_NAME = common.FONT2
+# Last surfaces kept to repaint only the days that changed, 0 disables it
+BASE_CACHE_SIZE = int(os.environ.get("CALENDAR_BASE_CACHE", 4))
+# Days are ordinals (date.toordinal() - 1), colors 3 hex digits ("F00")
+# and exceptions a tuple of days without the period
+Period = collections.namedtuple(
+    "Period", ("iDay", "fDay", "name", "color", "weekend", "exceptions")
+)
+# (iDay, weeks, smoothFactor, dpi) -> (surface, state of every day)
+_bases = collections.OrderedDict()
+
+
+def layout(dpi):
+    """
+    Size of the image, day width, extra width of the last day and header
+    height at a resolution (one of :data:`common.A4`)
+    """
+    size = common.A4[dpi]
+    width, extra_width = divmod(size[0], 7)
+    return size, width, extra_width, size[1] // 35
+
+
+SIZE, WIDTH, EXTRA_WIDTH, HEADER_HEIGHT = layout(common.DPI)
 
 
 def str2Date(s):
@@ -31,11 +53,66 @@ def str2Birthday(s):
     return m * 100 + d, name
 
 
+def str2Period(d):
+    """Create a Period from a dict with dd/mm/yyyy dates (as in cal.json)"""
+    color = d.get("color", "F00")
+    return Period(
+        str2Date(d["iDay"]),
+        str2Date(d.get("fDay", d["iDay"])),
+        d.get("name") or None,
+        color,
+        d.get("weekend", color),
+        tuple(map(str2Date, d.get("exceptions", ())))
+    )
+
+
 def get_color(s):
     return [int(s[i] + "F", 16) for i in range(3)]
 
 
 def generate(iDay_, weeks_, birthdays_, periods_, smoothFactor_, path_=None):
+    """
+    Generate the calendar from strings, as written in cal.json
+
+    :param str iDay_: A day of the first week (dd/mm/yyyy)
+    :param int weeks_: Number of weeks to paint
+    :param list birthdays_: Strings like "dd/mm-name"
+    :param list periods_: Dicts with iDay, fDay, name, color, weekend
+        and exceptions
+    :param int smoothFactor_: How light the colors are (0-255)
+
+    :param str path_: Image file path
+
+    :return: Either the data or None
+    :rtype: bytes or None
+    """
+    return render(str2Date(iDay_), weeks_,
+                  tuple(map(str2Birthday, birthdays_)),
+                  tuple(map(str2Period, periods_)), smoothFactor_, path_)
+
+
+def render(iDay_, weeks_, birthdays_, periods_, smoothFactor_, path_=None,
+           format_="png", dpi_=common.DPI):
+    """
+    Generate and optionally save the image. Arguments are never modified,
+    so they can be shared between renders
+
+    PNG surfaces are kept for the next render of the same weeks, which only
+    repaints the days whose color, period label or birthdays changed
+
+    :param int iDay_: A day (ordinal) of the first week
+    :param int weeks_: Number of weeks to paint
+    :param tuple birthdays_: Tuples (month * 100 + day, name)
+    :param tuple periods_: :class:`Period` tuples
+    :param int smoothFactor_: How light the colors are (0-255)
+
+    :param str path_: Image file path
+    :param str format_: png or svg
+    :param int dpi_: Resolution, one of :data:`common.A4`
+
+    :return: Either the data or None
+    :rtype: bytes or None
+    """
     def paint_day(day):
         def smooth_color(color, isOdd):
             val = (255 - smoothFactor_) // 5
@@ -47,7 +124,6 @@ def generate(iDay_, weeks_, birthdays_, periods_, smoothFactor_, path_=None):
         # Figure postion, size and color
         date = datetime.date.fromordinal(day + 1)
         dayNumber = date.day
-        birthdayDate = dayNumber + date.month * 100
         week = (day - iDay) // 7
         x = day % 7 * WIDTH
         y = HEADER_HEIGHT + week * HEIGHT + (dayNumber < 8)
@@ -55,7 +131,7 @@ def generate(iDay_, weeks_, birthdays_, periods_, smoothFactor_, path_=None):
         height = HEIGHT - (dayNumber < 8) - 1
         if week == weeks - 1:
             height += EXTRA_HEIGHT + 1
-        _color, periodName = periods.pop(day, (common.WHITE, None))
+        _color, periodName, names = states[day]
         color = smooth_color(_color, day % 7 & 1)
         # Blit day number
         if dayNumber == 1:
@@ -64,11 +140,12 @@ def generate(iDay_, weeks_, birthdays_, periods_, smoothFactor_, path_=None):
                 x += 1
                 width -= 1
             dayFont = common.fit_font(common.FONT_MONO, dayText,
-                                      (width, height // 3))
+                                      (width, height // 3), mx=MAX_FONT)
         else:
             dayText = str(dayNumber)
             dayFont = common.fit_font(common.FONT_MONO, dayText,
-                                      (width // 4, height // 3))
+                                      (width // 4, height // 3),
+                                      mx=MAX_FONT)
         daySize = dayFont.size(dayText)
         common.blit_text(image, dayFont, (x, y), dayText, common.BLACK,
                          color, size=(width, height), anchor="NW")
@@ -77,52 +154,49 @@ def generate(iDay_, weeks_, birthdays_, periods_, smoothFactor_, path_=None):
             topY += daySize[1]
         bottomY = y + height
         # Blit birthdays
-        try:
-            names = enumerate(birthdays[birthdayDate].split("\n"))
-        except KeyError:
-            names = []
+        names = enumerate(names.split("\n")) if names else ()
         for a, name in names:
             offset = (daySize[0] if not a and dayNumber != 1 else 0)
             birthdayHeigth = min(bottomY - topY, height // 3)
             if birthdayHeigth >= 8:
                 birthdayImageSide = min(int(birthdayHeigth * 0.8), width // 4)
                 birthdayImageSize = (birthdayImageSide, birthdayImageSide)
-                birthdayImage = common.pg_scale(GIFT_PNG, birthdayImageSize)
+                birthdayImage = common.scaled(GIFT_PNG, birthdayImageSize)
                 image.blit(birthdayImage, (x + offset, topY))
                 offset += birthdayImageSide
             birthdayWidth = (width - offset)
             birthdaySize = (birthdayWidth, birthdayImageSide)
             birthdayFont = common.fit_font(BIRTHDAY_FONT_NAME, name,
-                                           birthdaySize)
+                                           birthdaySize, mx=MAX_FONT)
             common.blit_text(image, birthdayFont, (x + offset, topY),
                              name, common.GRAY[100], color,
                              size=birthdaySize, anchor="SW")
             topY += birthdayImageSide
         # Blit period
-        if day in show:
+        if periodName is not None:
             periodText = "{%s}" % periodName
             periodSize = (width, min(bottomY - topY, height // 3))
-            font = common.fit_font(TEXT_FONT_NAME, periodText, periodSize)
+            font = common.fit_font(TEXT_FONT_NAME, periodText, periodSize,
+                                   mx=MAX_FONT)
             common.blit_text(image, font, (x, bottomY - periodSize[1]),
                              periodText, common.BLACK, color,
                              size=periodSize, anchor="SW")
 
     # Process arguments
-    weeks = min(max(weeks_, 1), 52)
-    iDay = str2Date(iDay_) // 7 * 7
-    birthdays = dict(map(str2Birthday, birthdays_))
+    weeks = min(max(weeks_, 1), series.MAX_WEEKS)
+    iDay = iDay_ // 7 * 7
+    birthdays = dict(birthdays_)
+    # Only the painted weeks, and the one before to know which labels to show
+    firstDay = iDay - 7
+    lastDay = iDay + weeks * 7 - 1
+    tree = interval.IntervalTree((p[0], p[1], Period(*p)) for p in periods_)
     periods = {}
-    for period in periods_:
-        iDay_ = str2Date(period["iDay"])
-        fDay = str2Date(period.pop("fDay", period["iDay"]))
-        name = period.pop("name", None)
-        if name == "":
-            name = None
-        _color = period.pop("color", "F00")
-        color = get_color(_color)
-        weekend = get_color(period.pop("weekend", _color))
-        exceptions = set(map(str2Date, period.pop("exceptions", tuple())))
-        for day in range(iDay_, fDay + 1):
+    for start, end, period in tree.overlap(firstDay, lastDay):
+        name = period.name or None
+        color = get_color(period.color)
+        weekend = get_color(period.weekend)
+        exceptions = set(period.exceptions)
+        for day in range(max(start, firstDay), min(end, lastDay) + 1):
             if day in exceptions:
                 continue
             if day % 7 > 4:
@@ -135,30 +209,52 @@ def generate(iDay_, weeks_, birthdays_, periods_, smoothFactor_, path_=None):
         if name is not None and name not in last[-7:]:
             show.add(day)
         last.append(name)
-    # Create image
-    image = common.pg_surface(SIZE)
-    image.fill(common.BLACK)
-    HEIGHT, EXTRA_HEIGHT = divmod(SIZE[1] - HEADER_HEIGHT, weeks)
-    for week in range(1, weeks):
-        y = HEADER_HEIGHT + week * HEIGHT - 1
-        image.fill(common.GRAY[200], rect=((0, y), (SIZE[0], 1)))
-    # Paint header
-    headerFont = common.fit_font(common.FONT_MONO, "0",
-                                 (WIDTH // 4, HEADER_HEIGHT))
-    for wDay in range(7):
-        x = wDay * WIDTH
-        width = WIDTH
-        if wDay == 6:
-            width += EXTRA_WIDTH
-        color = common.GRAY[215 if wDay & 1 else 225]
-        common.blit_text(image, headerFont, (x, 0), common.WEEK_DAYS[wDay],
-                         common.WHITE, color,
-                         size=(width, HEADER_HEIGHT), anchor="")
-    # Blit every week
+    # What is painted on every day: color, period label and birthdays
+    states = {}
     for day in range(iDay, iDay + weeks * 7):
+        date = datetime.date.fromordinal(day + 1)
+        color, name = periods.get(day, (common.WHITE, None))
+        states[day] = (tuple(color), name if day in show else None,
+                       birthdays.get(date.day + date.month * 100))
+    SIZE, WIDTH, EXTRA_WIDTH, HEADER_HEIGHT = layout(dpi_)
+    MAX_FONT = common.max_font_size(dpi_)
+    HEIGHT, EXTRA_HEIGHT = divmod(SIZE[1] - HEADER_HEIGHT, weeks)
+    # Reuse the last image of these weeks (taken out, so it is never shared)
+    key = (iDay, weeks, smoothFactor_, dpi_)
+    base = _bases.pop(key, None) if format_ == "png" else None
+    if base is not None:
+        image, previous = base
+        dirty = [day for day in states if previous.get(day) != states[day]]
+    else:
+        # Create image
+        image = common.new_surface(SIZE, format_)
+        image.fill(common.BLACK)
+        for week in range(1, weeks):
+            y = HEADER_HEIGHT + week * HEIGHT - 1
+            image.fill(common.GRAY[200], rect=((0, y), (SIZE[0], 1)))
+        # Paint header
+        headerFont = common.fit_font(common.FONT_MONO, "0",
+                                     (WIDTH // 4, HEADER_HEIGHT),
+                                     mx=MAX_FONT)
+        for wDay in range(7):
+            x = wDay * WIDTH
+            width = WIDTH
+            if wDay == 6:
+                width += EXTRA_WIDTH
+            color = common.GRAY[215 if wDay & 1 else 225]
+            common.blit_text(image, headerFont, (x, 0),
+                             common.WEEK_DAYS[wDay], common.WHITE, color,
+                             size=(width, HEADER_HEIGHT), anchor="")
+        dirty = states
+    # Blit every (changed) day
+    for day in dirty:
         paint_day(day)
-
-    return common.save(image, path=path_)
+    data = common.save(image, path=path_)
+    if format_ == "png" and BASE_CACHE_SIZE > 0:
+        _bases[key] = (image, states)
+        while len(_bases) > BASE_CACHE_SIZE:
+            _bases.popitem(last=False)
+    return data
 
 
 if __name__ == "__main__":
@@ -1,5 +1,11 @@
 #! python3
+import base64
+import functools
+import io
 import os
+import struct
+import zlib
+from xml.sax.saxutils import escape, quoteattr
 
 import pygame as pg
 
@@ -9,6 +15,8 @@ A4 = {
     150: (1240, 1754),
     300: (2480, 3508)
 }
+DPI = 150  # Full renders, smaller sizes can be downscaled from them
+FONT_MAX_SIZE = 50  # Largest font fitted at DPI, see max_font_size
 WEEK_DAYS = ("L", "M", "X", "J", "V", "S", "D")  # Spanish weekday first letter
 GRAY = [(i, i, i) for i in range(256)]
 WHITE = GRAY[255]
@@ -16,6 +24,17 @@ BLACK = GRAY[0]
 FONT1 = "dejavuserif"
 FONT2 = "dejavusans"
 FONT_MONO = "dejavusansmono"
+SVG_FAMILIES = {
+    FONT1: "DejaVu Serif, serif",
+    FONT2: "DejaVu Sans, sans-serif",
+    FONT_MONO: "DejaVu Sans Mono, monospace"
+}
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_COMPRESSION = int(os.environ.get("PNG_COMPRESSION", 6))  # zlib level
+TEXT_CACHE_SIZE = int(os.environ.get("TEXT_CACHE_SIZE", 4096))  # Surfaces
+SPRITE_CACHE_SIZE = 64
+
+FONT_INFO = {}  # Name and size of the fonts returned by get_font
 
 pg.font.init()
 pg_sys_font = pg.font.SysFont
@@ -23,35 +42,285 @@ pg_surface = pg.Surface
 pg_save = pg.image.save
 pg_load = pg.image.load
 pg_scale = pg.transform.scale
+pg_smoothscale = pg.transform.smoothscale
+pg_tostring = pg.image.tostring
+
+
+def _png_chunk(buffer, kind, data):
+    buffer.write(struct.pack(">I", len(data)))
+    buffer.write(kind)
+    buffer.write(data)
+    buffer.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
 
 
-def save(surface, path=None):
+def encode_png(surface, level=PNG_COMPRESSION, alpha=False):
     """
-    Save a surface to a path and return the data if necessary
+    Encode a surface as an RGB PNG without touching the disk
 
-    :param surface: Surface to be saved
+    :param surface: Surface to be encoded
     :type surface: pygame.Surface
 
+    :param int level: zlib compression level (0-9), trades CPU for bytes
+    :param bool alpha: Keep the transparency (RGBA)
+
+    :return: PNG data
+    :rtype: bytes
+    """
+    width, height = surface.get_size()
+    raw = memoryview(pg_tostring(surface, "RGBA" if alpha else "RGB"))
+    stride = width * (4 if alpha else 3)
+    # Every scanline is prefixed by its filter type (0, None)
+    scanlines = bytearray((stride + 1) * height)
+    for y in range(height):
+        start = y * (stride + 1) + 1
+        scanlines[start:start + stride] = raw[y * stride:(y + 1) * stride]
+
+    buffer = io.BytesIO()
+    buffer.write(PNG_SIGNATURE)
+    _png_chunk(buffer, b"IHDR",
+               struct.pack(">IIBBBBB", width, height, 8, 6 if alpha else 2,
+                           0, 0, 0))
+    _png_chunk(buffer, b"IDAT", zlib.compress(scanlines, level))
+    _png_chunk(buffer, b"IEND", b"")
+    return buffer.getvalue()  # Shares the buffer memory, no extra copy
+
+
+def _svg_color(color):
+    return "#%02x%02x%02x" % tuple(int(i) for i in color[:3])
+
+
+class SvgText:
+    """
+    Text waiting to be blitted into a :class:`SvgSurface`, it only knows
+    its size
+    """
+
+    def __init__(self, font, text, font_color, background_color):
+        self.font = font
+        self.text = text
+        self.font_color = font_color
+        self.background_color = background_color
+
+    def get_rect(self):
+        return pg.Rect((0, 0), self.font.size(self.text))
+
+
+class SvgSurface:
+    """
+    Stand-in for pygame.Surface that writes SVG elements instead of pixels.
+    Supports what the layout code uses: fill, blit and get_size
+
+    :param size: Document size in pixels
+    :type size: tuple(int, int)
+    """
+
+    def __init__(self, size):
+        self.size = tuple(size)
+        self.elements = []
+        self.images = {}  # Embedded sprites, by surface
+
+    def get_size(self):
+        return self.size
+
+    def fill(self, color, rect=None):
+        if rect is None:
+            self.elements.clear()  # Everything is covered
+            rect = ((0, 0), self.size)
+        rect = pg.Rect(rect)
+        if rect.width <= 0 or rect.height <= 0:
+            return
+        self.elements.append(
+            '<rect x="%d" y="%d" width="%d" height="%d" fill="%s"/>'
+            % (rect.x, rect.y, rect.width, rect.height, _svg_color(color))
+        )
+
+    def blit(self, source, position):
+        x, y = position[0], position[1]
+        if isinstance(source, SvgText):
+            self._text(source, x, y)
+            return
+        try:
+            image_id = self.images[source]
+        except KeyError:
+            image_id = self.images[source] = "i%d" % len(self.images)
+            data = base64.b64encode(encode_png(source, alpha=True)).decode()
+            width, height = source.get_size()
+            self.elements.append(
+                '<defs><image id="%s" width="%d" height="%d" '
+                'xlink:href="data:image/png;base64,%s"/></defs>'
+                % (image_id, width, height, data)
+            )
+        self.elements.append('<use xlink:href="#%s" x="%d" y="%d"/>'
+                             % (image_id, x, y))
+
+    def _text(self, text, x, y):
+        font = text.font
+        if text.background_color is not None:
+            self.fill(text.background_color, text.get_rect().move(x, y))
+        name, size = FONT_INFO.get(font, (None, font.get_height()))
+        self.elements.append(
+            '<text x="%d" y="%d" font-family=%s font-size="%dpx" fill="%s">'
+            '%s</text>' % (x, y + font.get_ascent(),
+                           quoteattr(SVG_FAMILIES.get(name, "sans-serif")),
+                           size, _svg_color(text.font_color),
+                           escape(text.text))
+        )
+
+    def encode(self):
+        """
+        :return: SVG document
+        :rtype: bytes
+        """
+        width, height = self.size
+        header = ('<svg xmlns="http://www.w3.org/2000/svg" '
+                  'xmlns:xlink="http://www.w3.org/1999/xlink" '
+                  'width="%d" height="%d" viewBox="0 0 %d %d">'
+                  % (width, height, width, height))
+        return "".join((header, *self.elements, "</svg>")).encode()
+
+
+def new_surface(size, format_="png"):
+    """
+    Create the surface to paint an image on
+
+    :param size: Image size
+    :type size: tuple(int, int)
+    :param str format_: png (pygame.Surface) or svg (:class:`SvgSurface`)
+    """
+    if format_ == "svg":
+        return SvgSurface(size)
+    return pg_surface(size)
+
+
+def save(surface, path=None, level=PNG_COMPRESSION):
+    """
+    Save a surface to a path or encode it in memory if there is no path
+
+    :param surface: Surface to be saved
+    :type surface: pygame.Surface or SvgSurface
+
     :param str path: File path
+    :param int level: PNG compression level when encoding in memory
 
     :return: Either the data or None
     :rtype: bytes or None
     """
-    path_ = path or os.urandom(32).hex() + ".png"
-    pg_save(surface, path_)
+    if isinstance(surface, SvgSurface):
+        data = surface.encode()
+        if not path:
+            return data
+        with open(path, "wb") as f:
+            f.write(data)
+        return None
+    if path:
+        pg_save(surface, path)
+        return None
+    return encode_png(surface, level)
+
+
+@functools.lru_cache(maxsize=None)
+def get_font(name, size):
+    """
+    Returns a system font, loading it only the first time it is requested
+
+    :param str name: Font name
+    :param int size: Font size
+
+    :return: Font of the desired size
+    :rtype: pygame.font.Font
+    """
+    font = pg_sys_font(name, size)
+    FONT_INFO[font] = (name, size)
+    return font
+
+
+class GlyphTable:
+    """
+    Advance widths of every glyph seen so far for a font of a given size.
+    Lets the width of a string be estimated adding integers instead of
+    asking the font renderer
+    """
+
+    def __init__(self, font):
+        self.font = font
+        self.height = font.get_height()
+        self.advances = {}
+
+    def _add(self, char):
+        metrics = self.font.metrics(char)[0]
+        if metrics is None:  # Glyph not present in the font
+            advance = self.font.size(char)[0]
+        else:
+            advance = metrics[4]
+        self.advances[char] = advance
+        return advance
+
+    def width(self, text):
+        advances = self.advances
+        width = 0
+        for char in text:
+            try:
+                width += advances[char]
+            except KeyError:
+                width += self._add(char)
+        return width
+
+
+@functools.lru_cache(maxsize=None)
+def glyph_table(name, size):
+    """
+    Returns the glyph metric table of a font
+
+    :param str name: Font name
+    :param int size: Font size
+
+    :rtype: GlyphTable
+    """
+    return GlyphTable(get_font(name, size))
+
+
+def max_font_size(dpi):
+    """
+    Largest font size for :func:`fit_font` at a resolution, the layouts
+    grow with it
+
+    :param int dpi: One of :data:`A4`
+    :rtype: int
+    """
+    return FONT_MAX_SIZE * dpi // DPI
 
-    if not path:
-        with open(path_, "rb") as f:
-            data = f.read()
-        os.remove(path_)
-        return data
-    return None
+
+def warm_up(names=(FONT1, FONT2, FONT_MONO), sizes=None):
+    """
+    Load every font that :func:`fit_font` may return, meant for fresh
+    rendering processes. By default every size up to the largest resolution
+    """
+    if sizes is None:
+        sizes = range(1, max_font_size(max(A4)) + 1)
+    for name in names:
+        for size in sizes:
+            glyph_table(name, size).width(" ▲▼0123456789/-.{}")
+
+
+def _fits(font, text, size, font_size):
+    width, height = get_font(font, font_size).size(text)
+    return width <= size[0] and height <= size[1]
+
+
+def _estimate_fits(font, text, size, font_size):
+    table = glyph_table(font, font_size)
+    return table.width(text) <= size[0] and table.height <= size[1]
 
 
-def fit_font(font, text, size, mn=1, mx=50, precision=1):
+@functools.lru_cache(maxsize=4096)
+def fit_font(font, text, size, mn=1, mx=FONT_MAX_SIZE, precision=1):
     """
     Returns a font (of type name) that fits size with text
 
+    The size is first estimated with the glyph tables and then adjusted
+    with the exact text size, so usually only one or two real measures
+    are needed. Results are cached by (font, text, size)
+
     :param str font: Text font
     :param str text: Text content
     :param size: Text size
@@ -64,16 +333,86 @@ def fit_font(font, text, size, mn=1, mx=50, precision=1):
     :return: Font of the desired size
     :rtype: pygame.font.Font
     """
-    target_width, target_height = size
-    while mx - mn > precision:
-        mean = (mx + mn) // 2
-        width, height = pg_sys_font(font, mean).size(text)
-
-        if width > target_width or height > target_height:
-            mx = mean
+    fits = _fits if precision > 1 else _estimate_fits
+    low, high = mn, mx
+    while high - low > precision:
+        mean = (high + low) // 2
+        if fits(font, text, size, mean):
+            low = mean
         else:
-            mn = mean
-    return pg_sys_font(font, (mx + mn) // 2)
+            high = mean
+    font_size = (high + low) // 2
+    if precision > 1:
+        return get_font(font, font_size)
+    # Correct the estimation with the exact size
+    if _fits(font, text, size, font_size):
+        while font_size + 1 < mx and _fits(font, text, size, font_size + 1):
+            font_size += 1
+    else:
+        while font_size > mn and not _fits(font, text, size, font_size):
+            font_size -= 1
+    return get_font(font, font_size)
+
+
+@functools.lru_cache(maxsize=TEXT_CACHE_SIZE)
+def render_text(font, text, antialiasing, font_color, background_color):
+    """
+    Cached :meth:`pygame.font.Font.render`, the surface returned is shared
+    so it must not be modified
+
+    :param font: Text font (as returned by :func:`get_font`)
+    :type font: pygame.font.Font
+    :param str text: Text content
+    :param bool antialiasing: Whether to smooth the edges
+    :param font_color: Font foreground color
+    :type font_color: tuple(int, int, int)
+    :param background_color: Font background color or None
+    :type background_color: tuple(int, int, int)
+
+    :rtype: pygame.Surface
+    """
+    return font.render(text, antialiasing, font_color, background_color)
+
+
+@functools.lru_cache(maxsize=SPRITE_CACHE_SIZE)
+def scaled(surface, size):
+    """
+    Cached :func:`pygame.transform.scale`, the surface returned is shared
+    so it must not be modified
+
+    :param surface: Original image
+    :type surface: pygame.Surface
+    :param size: Final size
+    :type size: tuple(int, int)
+
+    :rtype: pygame.Surface
+    """
+    return pg_scale(surface, size)
+
+
+def downscale(data, size, level=PNG_COMPRESSION):
+    """
+    Shrink an encoded PNG, much cheaper than laying out a smaller image
+
+    :param bytes data: PNG data
+    :param size: Final size
+    :type size: tuple(int, int)
+    :param int level: PNG compression level
+
+    :return: PNG data
+    :rtype: bytes
+    """
+    image = pg_load(io.BytesIO(data), "image.png")
+    return encode_png(pg_smoothscale(image, size), level)
+
+
+def cache_info():
+    """
+    Hits, misses and size of the font, text and sprite caches
+    """
+    return {name: function.cache_info()._asdict() for name, function in
+            (("fonts", get_font), ("fits", fit_font),
+             ("texts", render_text), ("sprites", scaled))}
 
 
 def blit_text(surface, font, position, text, font_color,
@@ -82,7 +421,7 @@ def blit_text(surface, font, position, text, font_color,
     Blits text into a pygame Surface following the parameters described below
 
     :param surface: Destination surface
-    :type surface: pygame.Surface
+    :type surface: pygame.Surface or SvgSurface
     :param font: Text font
     :type font: pygame.font.Font
     :param position: Text position inside the surface
@@ -101,7 +440,13 @@ def blit_text(surface, font, position, text, font_color,
     :return: None
     """
     antialiasing = True
-    rendered = font.render(text, antialiasing, font_color, background_color)
+    if background_color is not None:
+        background_color = tuple(background_color)
+    if isinstance(surface, SvgSurface):
+        rendered = SvgText(font, text, font_color, background_color)
+    else:
+        rendered = render_text(font, text, antialiasing, tuple(font_color),
+                               background_color)
 
     if size is None:
         surface.blit(rendered, position)
@@ -0,0 +1,70 @@
+#! python3
+
+
+class _Node:
+    def __init__(self, center, intervals, left, right):
+        self.center = center
+        self.by_start = sorted(intervals, key=lambda i: i[0])
+        self.by_end = sorted(intervals, key=lambda i: i[1], reverse=True)
+        self.left = left
+        self.right = right
+
+
+class IntervalTree:
+    """
+    Static centered interval tree, finds the intervals overlapping a range
+    in O(log n + k)
+
+    :param intervals: Tuples (start, end, value) with inclusive bounds
+    """
+
+    def __init__(self, intervals):
+        # The position is kept to return values in the original order
+        items = [(start, end, position, value) for position, (start, end, value)
+                 in enumerate(intervals)]
+        self._root = self._build(items)
+
+    def _build(self, items):
+        if not items:
+            return None
+        points = sorted(i[0] for i in items)
+        center = points[len(points) // 2]
+        left = [i for i in items if i[1] < center]
+        right = [i for i in items if i[0] > center]
+        here = [i for i in items if i[0] <= center <= i[1]]
+        return _Node(center, here, self._build(left), self._build(right))
+
+    def overlap(self, start, end):
+        """
+        Values of every interval overlapping [start, end], in the order
+        they were given
+
+        :param int start: First point of the range
+        :param int end: Last point of the range
+
+        :rtype: list
+        """
+        found = []
+        nodes = [self._root]
+        while nodes:
+            node = nodes.pop()
+            if node is None:
+                continue
+            if end < node.center:
+                for item in node.by_start:
+                    if item[0] > end:
+                        break
+                    found.append(item)
+                nodes.append(node.left)
+            elif start > node.center:
+                for item in node.by_end:
+                    if item[1] < start:
+                        break
+                    found.append(item)
+                nodes.append(node.right)
+            else:
+                found.extend(node.by_start)
+                nodes.append(node.left)
+                nodes.append(node.right)
+        found.sort(key=lambda i: i[2])
+        return [(i[0], i[1], i[3]) for i in found]
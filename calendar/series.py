@@ -0,0 +1,106 @@
+#! python3
+import array
+import struct
+
+MISSING = -32768  # Value of the days without data
+MAX_WEEKS = 54  # Weeks in one window, a year can touch 54 (from Monday)
+HEADER = struct.Struct("<q")  # First day
+
+
+class DaySeries:
+    """
+    Amounts of consecutive days stored in an ``array('h')``, two bytes per
+    day, with :const:`MISSING` marking the days without data. Windows
+    share the memory of the series they come from
+
+    :param int start: First day (date.toordinal() - 1)
+    :param values: Amount of every day since start
+    :type values: array.array or memoryview
+    """
+
+    __slots__ = ("start", "values")
+
+    def __init__(self, start, values):
+        self.start = start
+        self.values = memoryview(values)
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """
+        Create a series from (day, amount) pairs in any order
+
+        :param pairs: Iterable of tuples (day, amount)
+        :rtype: DaySeries
+        """
+        pairs = list(pairs)
+        if not pairs:
+            return cls(0, array.array("h"))
+        start = min(day for day, _ in pairs)
+        stop = max(day for day, _ in pairs) + 1
+        values = array.array("h", [MISSING]) * (stop - start)
+        for day, amount in pairs:
+            values[day - start] = amount
+        return cls(start, values)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Inverse of :meth:`to_bytes`
+        """
+        start, = HEADER.unpack_from(data)
+        values = array.array("h")
+        values.frombytes(data[HEADER.size:])
+        return cls(start, values)
+
+    def to_bytes(self):
+        """
+        First day and values (in native byte order) as bytes
+        """
+        return HEADER.pack(self.start) + self.values.tobytes()
+
+    def to_json(self):
+        return {"start": self.start,
+                "amounts": [None if i == MISSING else i for i in self.values]}
+
+    @property
+    def stop(self):
+        return self.start + len(self.values)
+
+    def window(self, start, stop):
+        """
+        Days from start (included) to stop (excluded), without copying
+
+        :rtype: DaySeries
+        """
+        start = min(max(start, self.start), self.stop)
+        stop = min(max(stop, start), self.stop)
+        return DaySeries(start, self.values[start - self.start:
+                                            stop - self.start])
+
+    def get(self, day, default=None):
+        if self.start <= day < self.stop:
+            value = self.values[day - self.start]
+            if value != MISSING:
+                return value
+        return default
+
+    def __iter__(self):
+        """
+        Yield (day, amount) for every day with data
+        """
+        for day, value in enumerate(self.values, self.start):
+            if value != MISSING:
+                yield day, value
+
+    def __len__(self):
+        return len(self.values)
+
+    def __eq__(self, other):
+        return (isinstance(other, DaySeries) and self.start == other.start
+                and self.values == other.values)
+
+    def __repr__(self):
+        return f"DaySeries.from_bytes({self.to_bytes()!r})"
+
+    def __reduce__(self):  # memoryview can not be pickled
+        return DaySeries.from_bytes, (self.to_bytes(),)
@@ -3,17 +3,42 @@ import datetime
 import json
 
 import common
+import series
+
+try:
+    import numpy as np
+    import pygame.surfarray as pg_surfarray
+except ImportError:  # The vectorized mode is optional
+    np = None
 
-SIZE = common.A4[150]
-# Width
-WIDTH, EXTRA_WIDTH = divmod(SIZE[0], 7)
-# Height
-HEADER_HEIGHT = SIZE[1] // 35
-PREFOOTER_HEIGHT = SIZE[1] // 20
-FOOTER_HEIGHT = PREFOOTER_HEIGHT
 # Background
 BLUE_VALUE = 80
 BACKGROUND_COLOR = (200 - BLUE_VALUE // 2, 200 - BLUE_VALUE // 2, 255)
+VECTORIZED = np is not None  # Default mode
+
+
+def layout(dpi):
+    """
+    Size of the image and its fixed parts at a resolution
+
+    :param int dpi: One of :data:`common.A4`
+
+    :return: Size, day width, extra width of the last day and header,
+        prefooter and footer heights
+    :rtype: tuple
+    """
+    size = common.A4[dpi]
+    # Width
+    width, extra_width = divmod(size[0], 7)
+    # Height
+    header_height = size[1] // 35
+    prefooter_height = size[1] // 20
+    return (size, width, extra_width, header_height, prefooter_height,
+            prefooter_height)
+
+
+(SIZE, WIDTH, EXTRA_WIDTH, HEADER_HEIGHT, PREFOOTER_HEIGHT,
+ FOOTER_HEIGHT) = layout(common.DPI)
 
 
 def get_color(value, average, step):
@@ -35,38 +60,129 @@ def get_color(value, average, step):
         return 255, 255 - substract, BLUE_VALUE
 
 
-def generate(weeks_, data_, path_=None):
+def fill_cells(image, data, rows, total_average, color_step,
+               row_step, row_offset, cell_height):
+    """
+    Fill the background of every day with data at once using NumPy
+
+    :param image: Destination surface
+    :type image: pygame.Surface
+    :param dict data: Amount of every day
+    :param dict rows: Row (non empty week number) of every week
+    :param float total_average: Average of every amount
+    :param float color_step: Color change per unit of difference
+
+    :param int row_step: Height of a week, including its header
+    :param int row_offset: Y of the first cell
+    :param int cell_height: Height of the cells
+
+    :return: Color of every day and average of every weekday (NaN if empty)
+    :rtype: tuple(dict, list)
+    """
+    size = image.get_size()
+    width_, extra_width = divmod(size[0], 7)
+    days = np.fromiter(data, dtype=np.int64, count=len(data))
+    values = np.fromiter(data.values(), dtype=np.float64, count=len(data))
+    row_of = np.array([rows[day // 7] for day in data], dtype=np.int64)
+    # Amount grid (weeks x 7) with NaN where there is no data
+    grid = np.full((len(rows), 7), np.nan)
+    grid[row_of, days % 7] = values
+    # Like np.nanmean, without its warning for the weekdays without data
+    counts = np.count_nonzero(~np.isnan(grid), axis=0)
+    with np.errstate(invalid="ignore"):
+        averages = (np.nansum(grid, axis=0) / counts).tolist()
+    # Color grid, same as get_color
+    substract = np.nan_to_num(np.abs(grid - total_average) * color_step)
+    above = grid > total_average
+    colors = np.empty(grid.shape + (3,), dtype=np.uint8)
+    colors[..., 0] = np.where(above, 255 - substract, 255).clip(0, 255)
+    colors[..., 1] = np.where(above, 255, 255 - substract).clip(0, 255)
+    colors[..., 2] = BLUE_VALUE
+    # Days without data keep the background
+    colors[np.isnan(grid)] = BACKGROUND_COLOR
+    # Pixel rows of the cells and the grid row each one belongs to
+    cell_rows = np.full(size[1], -1, dtype=np.int64)
+    for row in range(len(rows)):
+        y = row_step * row + row_offset + 2
+        cell_rows[y:y + max(cell_height - 4, 0)] = row
+    ys = np.flatnonzero(cell_rows >= 0)
+    # Colors as mapped pixel values of the surface
+    shifts = image.get_shifts()
+    mapped = (colors.astype(np.uint32) << shifts[:3]).sum(axis=2)
+    mapped |= image.get_masks()[3]  # Opaque
+    pixels = pg_surfarray.pixels2d(image)  # (x, y)
+    for wDay in range(7):
+        width = width_ + (extra_width if wDay == 6 else 0)
+        strip = mapped[cell_rows[ys], wDay]  # Color of every pixel row
+        pixels[width_ * wDay + 2:width_ * wDay + width - 2, ys] = strip
+    del pixels  # Unlock the surface
+    day_colors = {day: tuple(colors[row, day % 7].tolist())
+                  for day, row in zip(data, row_of.tolist())}
+    return day_colors, averages
+
+
+def generate(weeks_, data_, path_=None, aggregates_=None, vectorized_=None,
+             format_="png", dpi_=common.DPI, lastDay_=None):
     """
     Generate and optionally save the image
 
     :param int weeks_: Number of weeks to paint
-    :param list data_: List of tuples (day, amount)
+    :param data_: Amounts, or a list of tuples (day, amount)
+    :type data_: series.DaySeries
 
     :param str path_: Image file path
+    :param list aggregates_: List of tuples (week, total, count, minimum,
+        maximum) with the amounts of every painted week, saves going
+        through every day to get the average and color scale. Ignored if
+        they do not count every painted day
+    :param bool vectorized_: Paint the days with NumPy, only blitting the
+        text one by one. :const:`VECTORIZED` by default
+    :param str format_: png or svg
+    :param int dpi_: Resolution, one of :data:`common.A4`
+    :param int lastDay_: A day (ordinal) of the last week, today by default
 
     :return: Either the data or None
     :rtype: bytes or None
     """
     # Process arguments
-    weeks = min(max(weeks_, 1), 52)
+    weeks = min(max(weeks_, 1), series.MAX_WEEKS)
     data = {}
     weekly_values = [[], [], [], [], [], [], []]
-    today = (datetime.date.today().toordinal() - 1) // 7 * 7
+    if lastDay_ is None:
+        lastDay_ = datetime.date.today().toordinal() - 1
+    today = lastDay_ // 7 * 7  # Monday of the last week
     starting_day = today - (weeks - 1) * 7
-    for date, _amount in data_:
-        if date < starting_day:
-            continue
+    if not isinstance(data_, series.DaySeries):
+        data_ = series.DaySeries.from_pairs(data_)
+    for date, _amount in data_.window(starting_day, today + 7):
         amount = _amount / 10 if _amount % 10 else _amount // 10
         data[date] = amount
         weekly_values[date % 7].append(amount)
-    non_empty_weeks = set(i // 7 for i in data)
-    total_average = sum(data.values()) / len(data)
+    # Every week is painted when there is no data at all (old pages)
+    non_empty_weeks = (set(i // 7 for i in data) or
+                       set(range(starting_day // 7, today // 7 + 1)))
+    aggregates = [i for i in aggregates_ or ()
+                  if starting_day // 7 <= i[0] <= today // 7]
+    # Only trusted when they cover every day, they may miss some weeks
+    if aggregates and sum(i[2] for i in aggregates) == len(data):
+        total_average = (sum(i[1] for i in aggregates) /
+                         sum(i[2] for i in aggregates) / 10)
+        deviation = max(max(i[4] / 10 - total_average,
+                            total_average - i[3] / 10) for i in aggregates)
+    elif data:
+        total_average = sum(data.values()) / len(data)
+        deviation = max(abs(i - total_average) for i in data.values())
+    else:
+        total_average = deviation = 0
     try:
-        color_step = 255 / max(abs(i - total_average) for i in data.values())
+        color_step = 255 / deviation
     except ZeroDivisionError:
         color_step = 0
     # Create image
-    image = common.pg_surface(SIZE)
+    (SIZE, WIDTH, EXTRA_WIDTH, HEADER_HEIGHT, PREFOOTER_HEIGHT,
+     FOOTER_HEIGHT) = layout(dpi_)
+    MAX_FONT = common.max_font_size(dpi_)
+    image = common.new_surface(SIZE, format_)
     image.fill(BACKGROUND_COLOR)
     HEIGHT = ((SIZE[1] - HEADER_HEIGHT - PREFOOTER_HEIGHT -
                FOOTER_HEIGHT) // len(non_empty_weeks))
@@ -74,7 +190,7 @@ def generate(weeks_, data_, path_=None):
     HEIGHT -= WEEK_HEADER_HEIGHT
     # Paint header
     header_font = common.fit_font(common.FONT_MONO, "0",
-                                  (WIDTH // 4, HEADER_HEIGHT))
+                                  (WIDTH // 4, HEADER_HEIGHT), mx=MAX_FONT)
     for wDay in range(7):
         x = wDay * WIDTH
         width = WIDTH
@@ -84,6 +200,18 @@ def generate(weeks_, data_, path_=None):
         common.blit_text(image, header_font, (x, 0), common.WEEK_DAYS[wDay],
                          common.WHITE, color,
                          size=(width, HEADER_HEIGHT), anchor="")
+    if vectorized_ is None:
+        vectorized_ = VECTORIZED
+    vectorized_ = vectorized_ and format_ == "png"
+    if vectorized_:
+        rows = {week: row for row, week in enumerate(sorted(non_empty_weeks))}
+        colors, averages = fill_cells(
+            image, data, rows, total_average, color_step,
+            HEIGHT + WEEK_HEADER_HEIGHT, HEADER_HEIGHT + WEEK_HEADER_HEIGHT,
+            HEIGHT
+        )
+        weekly_values = [[] if average != average else [average]
+                         for average in averages]  # NaN: no data
     # Blit every day
     non_empty_week = -1
     iterator = iter(range(starting_day, starting_day + weeks * 7))
@@ -108,7 +236,8 @@ def generate(weeks_, data_, path_=None):
             sunday = datetime.date.fromordinal(day + 7).strftime("%d/%m")
             text = "%s - %s" % (monday, sunday)
             font = common.fit_font(common.FONT1, text,
-                                   (SIZE[0], int(WEEK_HEADER_HEIGHT * 0.9)))
+                                   (SIZE[0], int(WEEK_HEADER_HEIGHT * 0.9)),
+                                   mx=MAX_FONT)
             common.blit_text(image, font, (x, y), text, common.GRAY[100],
                              BACKGROUND_COLOR,
                              size=(SIZE[0], WEEK_HEADER_HEIGHT), anchor="")
@@ -119,7 +248,10 @@ def generate(weeks_, data_, path_=None):
             value = data[day]
         except KeyError:
             continue
-        color = get_color(value, total_average, color_step)
+        if vectorized_:
+            color = colors[day]
+        else:
+            color = get_color(value, total_average, color_step)
         if type(value) is int:
             text = "%s %d" % ("▲" if value > total_average else "▼", value)
         else:
@@ -127,14 +259,17 @@ def generate(weeks_, data_, path_=None):
         size = (width - 4, height - 4)
         text_size = (int(width * 0.8), int(height * 0.8))
         pos = (x + 2, y + 2)
-        font = common.fit_font(common.FONT_MONO, text, text_size)
-        image.fill(color, (pos, size))
+        font = common.fit_font(common.FONT_MONO, text, text_size,
+                               mx=MAX_FONT)
+        if not vectorized_:
+            image.fill(color, (pos, size))
         common.blit_text(image, font, pos, text, common.BLACK,
-                         color, size=size, anchor="")
+                         color, size=size, anchor="", fill=False)
     y = SIZE[1] - PREFOOTER_HEIGHT - FOOTER_HEIGHT
     # Paint prefooter
     prefooter_font = common.fit_font(common.FONT1, "Average:0.00",
-                                     (SIZE[0], PREFOOTER_HEIGHT))
+                                     (SIZE[0], PREFOOTER_HEIGHT),
+                                     mx=MAX_FONT)
     color = get_color(total_average, total_average, color_step)
     common.blit_text(image, prefooter_font, (0, y),
                      "Average: %.2f" % total_average,
@@ -143,7 +278,7 @@ def generate(weeks_, data_, path_=None):
     y += PREFOOTER_HEIGHT
     # Paint footer
     footer_font = common.fit_font(common.FONT1, "▲ 00.00",
-                                  (WIDTH, FOOTER_HEIGHT))
+                                  (WIDTH, FOOTER_HEIGHT), mx=MAX_FONT)
     for wDay, i in enumerate(weekly_values):
         try:
             average = sum(i) / len(i)
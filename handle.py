@@ -3,12 +3,16 @@ import datetime
 import functools
 import hashlib
 import os
-import time
+import sys
 
 import model
 import utils.log
 import utils.telegram
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "calendar"))
+import series
+
 LINK_KEY = os.environ["LINK_KEY"]
 MY_ID = utils.telegram.MY_ID
 BOT_ID = utils.telegram.BOT_ID
@@ -30,6 +34,7 @@ TELEGRAM_HELP = """Help:
 """
 DAY = datetime.timedelta(days=1)
 TODAY = datetime.datetime.today()  # Only used as a placeholder
+LISTENERS = []  # Called with the name of the data that changed
 
 logger = utils.log.get("handle")
 bot = utils.telegram.Bot()
@@ -47,44 +52,130 @@ def generate_link_token(path):
     return hashlib.sha512((LINK_KEY + path.lstrip("/")).encode()).hexdigest()
 
 
+def notify_change(name):
+    """
+    Tell the listeners that the data behind a /show/{name} image changed,
+    once the transaction that bumped its version (model.bump_version) has
+    been committed
+    """
+    for listener in LISTENERS:
+        listener(name)
+
+
 def hash_password(password):
     return hashlib.sha512(password.encode()).hexdigest()
 
 
-def pregenerate_calendar(weeks):
-    kw = {"iDay_": time.strftime("%d/%m/%Y"),
+def pregenerate_calendar(weeks, start=None):
+    """
+    Arguments of cal.render: days as ordinals, birthdays as
+    (month * 100 + day, name) and periods as cal.Period tuples
+
+    :param int weeks: Number of weeks
+    :param datetime.date start: A day of the first week, today by default
+    """
+    start = start or datetime.date.today()
+    kw = {"iDay_": start.toordinal() - 1,
           "weeks_": weeks, "smoothFactor_": 205}
-    birthdays = []
-    for bday in model.Birthday.select():
-        month, day = divmod(bday.date, 100)
-        birthdays.append(f"{day}/{month}-{bday.text}")
-    kw["birthdays_"] = tuple(birthdays)
+    kw["birthdays_"] = tuple(model.Birthday.select(
+        model.Birthday.date, model.Birthday.text
+    ).tuples())
+    weeks = min(max(weeks, 1), series.MAX_WEEKS)
+    monday = start - DAY * start.weekday()
+    # Painted weeks and the one before, see cal.render
+    query = model.Period.select().where(
+        model.Period.fdate >= monday - DAY * 7,
+        model.Period.idate <= monday + DAY * (weeks * 7 - 1)
+    ).order_by(model.Period.id)
     periods = []
-    for period in model.Period.select():
+    for period in query:
         color = period.text[:3]
         weekend = period.text[3:6]
         name = period.text[6:]
-        periods.append({
-            "iDay": period.idate.strftime("%d/%m/%Y"),
-            "fDay": period.fdate.strftime("%d/%m/%Y"),
-            "name": name,
-            "color": color,
-            "weekend": weekend
-        })
+        periods.append((period.idate.toordinal() - 1,
+                        period.fdate.toordinal() - 1,
+                        name, color, weekend, ()))
     kw["periods_"] = tuple(periods)
     return kw
 
 
-def pregenerate_sleep(weeks):
-    data = [(sleep.date.toordinal() - 1, sleep.amount)
-            for sleep in model.Sleep.select()]
-    return {"weeks_": weeks, "data_": tuple(data)}
+def last_day(weeks, start=None):
+    """
+    Last date painted by sleep.generate for the given weeks, the Sunday of
+    the current week or of the last week since start
+    """
+    if start is None:
+        start = datetime.date.today()
+    else:
+        start += DAY * 7 * (min(max(weeks, 1), series.MAX_WEEKS) - 1)
+    return start + DAY * (6 - start.weekday())
+
+
+def first_day(weeks, start=None):
+    """
+    First date painted by sleep.generate for the given weeks
+    """
+    weeks = min(max(weeks, 1), series.MAX_WEEKS)
+    return last_day(weeks, start) - DAY * (weeks * 7 - 1)
 
 
-def pregenerate_out(weeks):
-    data = [(out.date.toordinal() - 1, out.amount)
-            for out in model.Out.select()]
-    return {"weeks_": weeks, "data_": tuple(data)}
+def date_week(date):
+    return (date.toordinal() - 1) // 7
+
+
+def load_aggregates(kind, weeks, start=None):
+    """
+    Read (week, total, count, minimum, maximum) of the painted weeks
+    """
+    query = (model.WeekAggregate
+             .select(model.WeekAggregate.week, model.WeekAggregate.total,
+                     model.WeekAggregate.count, model.WeekAggregate.minimum,
+                     model.WeekAggregate.maximum)
+             .where(model.WeekAggregate.kind == kind,
+                    model.WeekAggregate.week.between(
+                        date_week(first_day(weeks, start)),
+                        date_week(last_day(weeks, start))))
+             .order_by(model.WeekAggregate.week)
+             .tuples())
+    return tuple(query.iterator())
+
+
+def load_amounts(correct_model, weeks, start=None):
+    """
+    Read the amounts inside the painted window without building model
+    instances. The range is read through the date primary key, so old
+    pages only touch their own rows
+
+    :rtype: series.DaySeries
+    """
+    query = (correct_model
+             .select(correct_model.date, correct_model.amount)
+             .where(correct_model.date.between(first_day(weeks, start),
+                                               last_day(weeks, start)))
+             .order_by(correct_model.date)
+             .tuples())
+    return series.DaySeries.from_pairs(
+        (date.toordinal() - 1, amount) for date, amount in query.iterator()
+    )
+
+
+def pregenerate_amounts(kind, correct_model, weeks, start=None):
+    """
+    Arguments of sleep.generate, the last weeks or the weeks since start
+    """
+    kw = {"weeks_": weeks, "data_": load_amounts(correct_model, weeks, start),
+          "aggregates_": load_aggregates(kind, weeks, start)}
+    if start is not None:
+        kw["lastDay_"] = last_day(weeks, start).toordinal() - 1
+    return kw
+
+
+def pregenerate_sleep(weeks, start=None):
+    return pregenerate_amounts("sleep", model.Sleep, weeks, start)
+
+
+def pregenerate_out(weeks, start=None):
+    return pregenerate_amounts("out", model.Out, weeks, start)
 
 
 def handle_register(cmd, username, password, role):
@@ -124,16 +215,21 @@ def handle_birthday(cmd, name, date_str):
     day, month = date_str.split("/")
     date = int(day) + int(month) * 100
 
-    bday, created = model.Birthday.get_or_create(
-        date=date,
-        defaults={"text": ""}
-    )
+    with model.db.atomic():
+        bday, created = model.Birthday.get_or_create(
+            date=date,
+            defaults={"text": ""}
+        )
+        if name == "delete":
+            bday.delete_instance()
+        else:
+            bday.text = name
+            bday.save()
+        model.bump_version("calendar")
+    notify_change("calendar")
     if name == "delete":
-        bday.delete_instance()
         report(f"Birthday deleted ({date_str})")
     else:
-        bday.text = name
-        bday.save()
         report(f"Birthday set ({name} {date_str})")
 
 
@@ -149,17 +245,22 @@ def handle_period(cmd, name, color, weekend, idate_str, *args):
     if fdate.year < 1000:
         fdate = fdate.replace(year=fdate.year + 2000)
 
-    period, created = model.Period.get_or_create(
-        idate=idate,
-        fdate=fdate,
-        defaults={"text": ""}
-    )
+    with model.db.atomic():
+        period, created = model.Period.get_or_create(
+            idate=idate,
+            fdate=fdate,
+            defaults={"text": ""}
+        )
+        if name == "delete":
+            period.delete_instance()
+        else:
+            period.text = name
+            period.save()
+        model.bump_version("calendar")
+    notify_change("calendar")
     if name == "delete":
-        period.delete_instance()
         report(f"Period deleted ({period.text} {idate_str}-{fdate_str})")
     else:
-        period.text = name
-        period.save()
         report(f"Birthday set ({name} {idate_str}-{fdate_str})")
 
 
@@ -207,33 +308,71 @@ def handle_sleep_and_out(cmd_unstripped, hour_str, *args):
         if date.year < 1000:
             date = date.replace(year=date.year + 2000)
 
-    instance, created = model.State.get_or_create(
-        name=cmd_table[cmd],
-        defaults={"date": TODAY, "state": "null"}
-    )
-    backup, created = model.State.get_or_create(
-        name="back" + cmd_table[cmd],
-        defaults={"date": TODAY, "state": "null"}
-    )
+    name = cmd_table[cmd]
+    with model.db.atomic():
+        changed = sleep_and_out_transition(cmd, name, date, hour, minute)
+        if changed:
+            model.bump_version(name)
+    if changed:
+        notify_change(name)
+
+
+def lock_states(name):
+    """
+    Get the state and backup state of name (creating them if needed),
+    locked until the transaction ends
+    """
+    names = (name, "back" + name)
+    (model.State
+     .insert_many([{"name": i, "date": TODAY, "state": "null"} for i in names])
+     .on_conflict_ignore()
+     .execute())
+    query = model.State.select().where(model.State.name.in_(names))
+    if model.db.for_update:  # Not in SQLite, which locks the whole database
+        query = query.for_update()
+    states = {state.name: state for state in query}
+    return states[name], states["back" + name]
+
+
+def upsert_amount(cmd, date, amount, add=True):
+    """
+    Add amount to (or replace) the amount of a date in a single statement
+    and update the aggregate of its week
+    """
+    correct_model = model.AMOUNT_MODELS[cmd]
+    update = correct_model.amount + amount if add else amount
+    (correct_model
+     .insert(date=date, amount=amount)
+     .on_conflict(conflict_target=[correct_model.date],
+                  update={correct_model.amount: update})
+     .execute())
+    model.refresh_week(cmd, date_week(date))
+
+
+def sleep_and_out_transition(cmd, name, date, hour, minute):
+    """
+    Start/stop/backup state machine of handle_sleep_and_out, meant to run
+    inside a transaction
+
+    :return: Whether the amounts changed
+    :rtype: bool
+    """
+    instance, backup = lock_states(name)
     if hour > 23 or minute > 59:  # "Delete"
         instance.date = backup.date
         instance.state = backup.state
         instance.save()
         report(f"'Deleted' {cmd} ({date})")
         if cmd == "awake" or cmd == "home":
-            correct_model = model.Sleep if cmd == "awake" else model.Out
-            subinst, created = correct_model.get_or_create(
-                date=date,
-                defaults={"amount": 0}
-            )
-            subinst.amount = 0
-            subinst.save()
+            upsert_amount(name, date, 0, add=False)
             report(f"Set to 0 {cmd} ({date})")
-        return
+            return True
+        return False
     # Create backup
-    backup.date = instance.date
-    backup.state = instance.state
-    backup.save()
+    if (backup.date, backup.state) != (instance.date, instance.state):
+        backup.date = instance.date
+        backup.state = instance.state
+        backup.save()
     if cmd == "sleep" or cmd == "out":
         # Start
         instance.date = date
@@ -243,7 +382,7 @@ def handle_sleep_and_out(cmd_unstripped, hour_str, *args):
     elif cmd == "awake" or cmd == "home":
         if instance.state != "start":
             report(f"Doing nothing about {cmd} ({instance.state})")
-            return
+            return False
         idate = instance.date
         delta = date - idate
         # Stop
@@ -251,29 +390,30 @@ def handle_sleep_and_out(cmd_unstripped, hour_str, *args):
         instance.state = "stop"
         instance.save()
         report(f"Stopped {cmd} ({date})")
-        add_amount(cmd_table[cmd], delta, date)
+        return add_amount(name, delta, date)
+    return False
 
 
 def add_amount(cmd, delta, date):
+    """
+    :return: Whether the amount was added
+    :rtype: bool
+    """
     # TODO: Add to google
     amount = int(delta.total_seconds()) // 60  # Minutes
     if amount < 10:
         report(f"Amount was so little I ignored it {cmd} ({amount})")
-        return
+        return False
 
     final_amount = int(amount / 60 * 10)  # Amount added to database
-    correct_model = model.Sleep if cmd == "sleep" else model.Out
-    instance, created = correct_model.get_or_create(
-        date=date,
-        defaults={"amount": 0}
-    )
-    instance.amount += final_amount
-    instance.save()
+    upsert_amount(cmd, date, final_amount)
     report(f"Added amount {cmd} ({amount}->{final_amount} {date})")
+    return True
 
 
 def ifttt(data):
-    handle_sleep_and_out(data["cmd"], "-1:-1")
+    with bot.batch():
+        handle_sleep_and_out(data["cmd"], "-1:-1")
 
 
 HANDLE_COMMAND = {
@@ -289,6 +429,11 @@ HANDLE_COMMAND = {
 
 
 def handle(data):
+    with bot.batch():  # A single report message per update
+        _handle(data)
+
+
+def _handle(data):
     try:
         message = data["message"]
     except KeyError:  # Message has been edited
@@ -1,6 +1,10 @@
 #! python3
+import concurrent.futures
+import datetime
 import functools
+import gzip
 import hashlib
+import io
 import os
 import sys
 import time
@@ -8,13 +12,19 @@ import zlib
 
 import falcon
 
+import bulk
 import handle
 import model
+import utils.cache
+import utils.executor
 import utils.log
 import utils.telegram
+import utils.worker
 
 sys.path.insert(0, os.path.abspath("calendar"))
 import cal
+import common
+import series
 import sleep
 
 
@@ -39,12 +49,36 @@ STATIC_PATH = {
 SHOW_FUNCTIONS = {
     "sleep": (handle.pregenerate_sleep, sleep.generate),
     "out": (handle.pregenerate_out, sleep.generate),
-    "calendar": (handle.pregenerate_calendar, cal.generate)
+    "calendar": (handle.pregenerate_calendar, cal.render)
 }
+SHOW_FORMATS = {"png": "image/png", "svg": "image/svg+xml"}
+SHOW_PAGES = ("year", "quarter")
+# Images of days alone, calendar pages also show every (yearly) birthday
+HISTORY_NAMES = ("sleep", "out")
 IFTTT_TOKEN = os.environ["IFTTT_TOKEN"]
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", 32))
+PREWARM_WEEKS = tuple(int(weeks) for weeks in
+                      os.environ.get("PREWARM_WEEKS", "26").split(","))
+PREWARM_DELAY = float(os.environ.get("PREWARM_DELAY", 5))  # Debounce
+RENDER_PROCESSES = int(os.environ.get("RENDER_PROCESSES", 0))  # 0: inline
+RENDER_MAX_PENDING = int(os.environ.get("RENDER_MAX_PENDING", 8))
+RENDER_TIMEOUT = float(os.environ.get("RENDER_TIMEOUT", 30))
+SINGLE_FLIGHT_DIR = os.environ.get("SINGLE_FLIGHT_DIR")  # Across workers
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", 100))
+UPDATE_RETRIES = int(os.environ.get("UPDATE_RETRIES", 3))
+HISTORY_MAX_AGE = int(os.environ.get("HISTORY_MAX_AGE", 30 * 86400))
 
 logger = utils.log.get("main")
 bot = utils.telegram.Bot()
+fingerprint_cache = utils.cache.LRUCache(RENDER_CACHE_SIZE)
+render_cache = utils.cache.LRUCache(RENDER_CACHE_SIZE)
+# Last-Modified of the windows, evicted ones start again from now
+modified_times = utils.cache.LRUCache(RENDER_CACHE_SIZE)
+fingerprint_flight = utils.cache.SingleFlight()
+render_flight = utils.cache.SingleFlight(SINGLE_FLIGHT_DIR)
+render_executor = utils.executor.Executor(
+    RENDER_PROCESSES, RENDER_MAX_PENDING, RENDER_TIMEOUT, common.warm_up
+)
 
 
 def report(s):
@@ -54,6 +88,19 @@ def report(s):
         logger.exception(e)
 
 
+def process_update(item):
+    function, data = item
+    with model.db.connection_context():
+        function(data)
+
+
+def update_failed(item, ex):
+    function, data = item
+    report(str(ex))
+    logger.error(str(data))
+    report(str(data))
+
+
 def handle_exception(ex, req, resp, params):
     """
     Falcon internal exception handler. Logs to logger.error
@@ -73,6 +120,49 @@ def load(fpath):
     return data
 
 
+class Asset:
+    """
+    In memory static file with its ETag and compressed variants
+    """
+
+    def __init__(self, content, content_type, etag=None):
+        self.content_type = content_type
+        self.etag = etag or str(zlib.crc32(content))
+        self.variants = {"identity": content}
+        for encoding, compress in (("gzip", gzip.compress),
+                                   ("deflate", zlib.compress)):
+            compressed = compress(content, 9)
+            if len(compressed) < len(content):
+                self.variants[encoding] = compressed
+
+    def encoding(self, accept_encoding):
+        """
+        Choose the best variant for an Accept-Encoding header
+        """
+        accepted = set()
+        for item in (accept_encoding or "").split(","):
+            encoding, _, params = item.partition(";")
+            quality = params.replace(" ", "")
+            if quality in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                continue  # Explicitly refused
+            accepted.add(encoding.strip().lower())
+        for encoding in ("gzip", "deflate"):
+            if encoding in self.variants and (encoding in accepted or
+                                              "*" in accepted):
+                return encoding
+        return "identity"
+
+
+@functools.lru_cache(maxsize=None)
+def static_asset(fpath, content_type):
+    return Asset(load(fpath), content_type)
+
+
+@functools.lru_cache(maxsize=None)
+def role_asset(role):
+    return Asset(load("docs/js/role.js") % role, "application/javascript")
+
+
 @functools.lru_cache(maxsize=None)
 def generate_user_token(role, hour):
     base = handle.LINK_KEY + str(role) + str(hour)
@@ -84,18 +174,205 @@ def redirect(req, res, location):
     res.status = falcon.HTTP_303  # Force GET
 
 
-def upload(req, res, content, content_type, cache=("public", "max-age=86400")):
-    crc = str(zlib.crc32(content))
+def not_modified(req, etag, last_modified=None):
+    """
+    Whether a conditional request already has the current representation
+    """
+    if req.if_none_match is not None:
+        return req.if_none_match == etag
+    since = req.get_header_as_datetime("If-Modified-Since")
+    return None not in (since, last_modified) and last_modified <= since
+
+
+def upload(req, res, content, content_type, cache=("public", "max-age=86400"),
+           etag=None, last_modified=None):
+    etag = etag or str(zlib.crc32(content))
     res.cache_control = cache
 
-    if req.if_none_match == crc:  # Cached
+    if not_modified(req, etag, last_modified):  # Cached
         res.status = falcon.HTTP_304
     else:
-        res.etag = crc
+        res.etag = etag
+        if last_modified is not None:
+            res.last_modified = last_modified
         res.content_type = content_type
         res.data = content
 
 
+def upload_asset(req, res, asset, cache=("public", "max-age=86400"),
+                 last_modified=None):
+    encoding = asset.encoding(req.get_header("Accept-Encoding"))
+    etag = asset.etag if encoding == "identity" else f"{asset.etag}-{encoding}"
+    res.vary = ("Accept-Encoding",)
+    res.cache_control = cache
+
+    if not_modified(req, etag, last_modified):  # Cached
+        res.status = falcon.HTTP_304
+    else:
+        res.etag = etag
+        if last_modified is not None:
+            res.last_modified = last_modified
+        if encoding != "identity":
+            res.set_header("Content-Encoding", encoding)
+        res.content_type = asset.content_type
+        res.data = asset.variants[encoding]
+
+
+def fingerprint(name, weeks, start=None):
+    """
+    Get the inputs of /show/{name} and a fingerprint of them (with the date,
+    or the start of the range) that can be used as ETag before rendering
+    anything. Cached until the data version changes, which is read from the
+    database so writes from other processes are seen too
+
+    :return: ETag, last modification datetime and pregenerated arguments
+    :rtype: tuple(str, datetime.datetime, dict)
+    """
+    day = datetime.date.today().toordinal()
+    key = (name, weeks, start, day, model.data_version(name))
+    entry = fingerprint_cache.get(key)
+    if entry is None:
+        entry = fingerprint_flight.do(key, _fingerprint, name, weeks, start,
+                                      day)
+        fingerprint_cache.set(key, entry)
+    return entry
+
+
+def _fingerprint(name, weeks, start, day):
+    pre, final = SHOW_FUNCTIONS[name]
+    args = pre(weeks, start)
+    base = repr((name, weeks, start or day, args)).encode()
+    etag = hashlib.sha1(base).hexdigest()
+    last_etag, last_modified = modified_times.get((name, weeks, start),
+                                                  (None, None))
+    if etag != last_etag:
+        last_modified = datetime.datetime.utcnow().replace(microsecond=0)
+        modified_times.set((name, weeks, start), (etag, last_modified))
+    return etag, last_modified, args
+
+
+def page_range(per, page, today=None):
+    """
+    First and last date of a page, counting back from the current one (0)
+
+    :param str per: year or quarter
+    :param int page: Pages before the current one
+    """
+    today = today or datetime.date.today()
+    if per == "year":
+        year = today.year - page
+        return datetime.date(year, 1, 1), datetime.date(year, 12, 31)
+    year, quarter = divmod(today.year * 4 + (today.month - 1) // 3 - page, 4)
+    following = datetime.date(year + quarter // 3, (quarter * 3 + 3) % 12 + 1,
+                              1)
+    return datetime.date(year, quarter * 3 + 1, 1), following - handle.DAY
+
+
+def show_window(req):
+    """
+    Weeks painted by /show/{name}: the last ``weeks`` weeks by default, a
+    ``from``/``to`` range (yyyy-mm-dd) or a page (``per`` year or quarter
+    and ``page``, 0 for the current one)
+
+    :return: Number of weeks, first date (None for the last weeks) and
+        whether they are the past weeks of a ``from``/``to`` range, pages
+        count back from today so the same one moves on to other weeks
+    :rtype: tuple(int, datetime.date, bool)
+    """
+    per = req.get_param("per")
+    if per is not None:
+        if per not in SHOW_PAGES:
+            raise falcon.HTTPBadRequest("Bad page", "Use year or quarter")
+        try:
+            first, last = page_range(per,
+                                     req.get_param_as_int("page", min=0) or 0)
+        except ValueError:
+            raise falcon.HTTPBadRequest("Bad page", "Out of range")
+    else:
+        first = req.get_param_as_date("from")
+        last = req.get_param_as_date("to")
+        if first is None and last is None:
+            return int(req.params.get("weeks", 26)), None, False
+        if first is None or last is None:
+            raise falcon.HTTPBadRequest("Bad range", "Use both from and to")
+    weeks = handle.date_week(last) - handle.date_week(first) + 1
+    if not 0 < weeks <= series.MAX_WEEKS:
+        raise falcon.HTTPBadRequest(
+            "Bad range", f"Use up to {series.MAX_WEEKS} weeks, or pages"
+        )
+    closed = (per is None and
+              handle.date_week(last) < handle.date_week(datetime.date.today()))
+    return weeks, first, closed
+
+
+def variant_etag(etag, fmt="png", dpi=common.DPI):
+    """
+    ETag of a format and resolution of the image with a fingerprint
+    """
+    if fmt != "png":
+        etag = f"{etag}-{fmt}"
+    if dpi != common.DPI:
+        etag = f"{etag}-{dpi}"
+    return etag
+
+
+def render(name, etag, args, fmt="png", dpi=common.DPI):
+    """
+    Render /show/{name}, reusing the last image with the same fingerprint.
+    Concurrent requests for the same image wait for a single render.
+    Smaller PNGs are downscaled from the full (cached) one
+
+    :return: PNG data, or an :class:`Asset` with the compressed variants
+        for text formats (SVG)
+    """
+    variant = variant_etag(etag, fmt, dpi)
+    content = render_cache.get(variant)
+    if content is None:
+        if fmt == "png" and dpi < common.DPI:
+            content = render_flight.do(
+                (name, variant), common.downscale,
+                render(name, etag, args), common.A4[dpi]
+            )
+        else:
+            content = render_flight.do((name, variant), _render, name, args,
+                                       fmt, dpi)
+        if fmt != "png":
+            content = Asset(content, SHOW_FORMATS[fmt], variant)
+        render_cache.set(variant, content)
+    return content
+
+
+def _render(name, args, fmt, dpi):
+    pre, final = SHOW_FUNCTIONS[name]
+    if fmt != "png":
+        args = dict(args, format_=fmt)
+    if dpi != common.DPI:
+        args = dict(args, dpi_=dpi)
+    try:
+        return render_executor.run(final, **args)
+    except utils.executor.Busy as ex:
+        raise falcon.HTTPServiceUnavailable(
+            "Busy", str(ex), retry_after=int(RENDER_TIMEOUT)
+        )
+    except concurrent.futures.TimeoutError:
+        raise falcon.HTTPServiceUnavailable(
+            "Timeout", f"Rendering {name} took too long",
+            retry_after=int(RENDER_TIMEOUT)
+        )
+
+
+def prewarm(names):
+    """
+    Render the usual /show/{name} images again after their data changed
+    """
+    for name in names:
+        for weeks in PREWARM_WEEKS:
+            with model.db.connection_context():
+                etag, last_modified, args = fingerprint(name, weeks)
+            render(name, etag, args)
+            logger.debug(f"Prewarmed {name} ({weeks} weeks)")
+
+
 def static_serve(req, res):
     if req.path not in STATIC_PATH:
         redirect(req, res, "/")
@@ -106,8 +383,7 @@ def static_serve(req, res):
         redirect(req, res, "/")
         return
 
-    content = load(fpath)
-    upload(req, res, content, content_type)
+    upload_asset(req, res, static_asset(fpath, content_type))
 
 
 def authenticate(username, password):
@@ -144,32 +420,124 @@ class AuthMiddleware:
             logger.debug("Did not authorize")
 
 
+class DatabaseMiddleware:
+    """
+    Check a pooled connection out for every routed request and give it back
+    once the response is ready
+    """
+
+    def process_resource(self, req, resp, resource, params):
+        model.db.connect(reuse_if_open=True)
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if not model.db.is_closed():
+            model.db.close()
+
+
 class RoleResource:
     def on_get(self, req, res):
-        content = load("docs/js/role.js") % req.role
-        upload(req, res, content, "application/javascript", ("no-cache",))
+        upload_asset(req, res, role_asset(req.role), ("no-cache",))
 
 
 class ShowResource:
     def on_get(self, req, res, name):
         real_name = name.lstrip("$")
-        weeks = int(req.params.get("weeks", 26))
+        fmt = req.params.get("format", "png")
+        if req.get_param_as_bool("thumbnail"):
+            dpi = min(common.A4)
+        else:
+            dpi = req.get_param_as_int("dpi") or common.DPI
 
         if real_name in SHOW_FUNCTIONS:
             if req.role < 2:
                 raise falcon.HTTPForbidden("Try with a higher role")
-            pre, final = SHOW_FUNCTIONS[real_name]
-
-            args = pre(weeks)
-
+            if fmt not in SHOW_FORMATS:
+                raise falcon.HTTPBadRequest("Bad format", "Use png or svg")
+            if dpi not in common.A4:
+                raise falcon.HTTPBadRequest(
+                    "Bad resolution", "Use " + ", ".join(map(str, common.A4))
+                )
+            weeks, start, closed = show_window(req)
+            # Past days can still be edited (dated commands, bulk imports),
+            # browsers see that once HISTORY_MAX_AGE is over
+            cache = (("public", f"max-age={HISTORY_MAX_AGE}", "immutable")
+                     if closed and real_name in HISTORY_NAMES
+                     else ("public", "max-age=86400"))
             if name.startswith("$"):
-                res.media = args
+                pre, final = SHOW_FUNCTIONS[real_name]
+                res.media = {key: value.to_json()
+                             if isinstance(value, series.DaySeries) else value
+                             for key, value in pre(weeks, start).items()}
             else:
-                upload(req, res, final(**args), "image/png")
+                etag, last_modified, args = fingerprint(real_name, weeks,
+                                                        start)
+                variant = variant_etag(etag, fmt, dpi)
+                # Text formats are tagged by their compressed variant too
+                tags = ((variant, f"{variant}-gzip", f"{variant}-deflate")
+                        if fmt != "png" else (variant,))
+                if any(not_modified(req, tag, last_modified)
+                       for tag in tags):  # Skip render
+                    if fmt != "png":
+                        res.vary = ("Accept-Encoding",)
+                    res.cache_control = cache
+                    res.status = falcon.HTTP_304
+                    return
+                if fmt != "png":
+                    upload_asset(req, res,
+                                 render(real_name, etag, args, fmt, dpi),
+                                 cache, last_modified)
+                    return
+                upload(req, res, render(real_name, etag, args, dpi=dpi),
+                       "image/png", cache, variant, last_modified)
         else:
             redirect(req, res, "/img/cat.png")
 
 
+class MetricsResource:
+    def on_get(self, req, res):
+        if req.role < 2:
+            raise falcon.HTTPForbidden("Try with a higher role")
+        res.media = {
+            "render": render_executor.metrics(),
+            "updates": update_queue.counters,
+            "database": model.pool_metrics(),
+            "fonts": common.cache_info(),
+            "render_cache": {"size": len(render_cache),
+                             "hits": render_cache.hits,
+                             "misses": render_cache.misses,
+                             "shared": render_flight.shared},
+        }
+        res.cache_control = ("no-cache",)
+
+
+class BulkResource:
+    def _check(self, req, kind, role):
+        if kind not in bulk.FIELDS:
+            raise falcon.HTTPNotFound()
+        if req.role < role:
+            raise falcon.HTTPForbidden("Try with a higher role")
+        fmt = req.params.get("format", "csv")
+        if fmt not in bulk.CONTENT_TYPES:
+            raise falcon.HTTPBadRequest("Bad format", "Use csv or jsonl")
+        return fmt
+
+    def on_get(self, req, res, kind):
+        fmt = self._check(req, kind, 2)
+        res.content_type = bulk.CONTENT_TYPES[fmt]
+        res.cache_control = ("no-cache",)
+        res.stream = bulk.export(kind, fmt)
+
+    def on_post(self, req, res, kind):
+        fmt = self._check(req, kind, 9)
+        lines = io.TextIOWrapper(req.bounded_stream, encoding="utf-8",
+                                 newline="")
+        try:
+            total = bulk.ingest(kind, fmt, lines)
+        except (KeyError, ValueError) as ex:
+            raise falcon.HTTPBadRequest("Bad row", str(ex))
+        res.media = {"rows": total}
+
+
 class LoginResource:
     def on_post(self, req, res):
         redirect(req, res, "/")
@@ -197,39 +565,50 @@ class LoginResource:
 
 class TelegramResource:
     def on_post(self, req, res):
-        try:
-            handle.handle(req.media)
-        except Exception as ex:
-            logger.exception(ex)
-            report(str(ex))
-            logger.error(str(req.media))
-            report(str(req.media))
+        data = req.media
+        if not isinstance(data, dict) or "update_id" not in data:
+            raise falcon.HTTPBadRequest("Bad update", "Missing update_id")
+        if not update_queue.put((handle.handle, data), data["update_id"]):
+            raise falcon.HTTPServiceUnavailable("Busy", "Too many updates",
+                                                retry_after=10)
 
 
 class IftttResource:
     def on_post(self, req, res):
-        try:
-            handle.ifttt(req.media)
-        except Exception as ex:
-            logger.exception(ex)
-            report(str(ex))
-            logger.error(str(req.media))
-            report(str(req.media))
+        data = req.media
+        if not isinstance(data, dict) or "cmd" not in data:
+            raise falcon.HTTPBadRequest("Bad request", "Missing cmd")
+        if not update_queue.put((handle.ifttt, data)):
+            raise falcon.HTTPServiceUnavailable("Busy", "Too many updates",
+                                                retry_after=10)
 
 
 logger.info("Creating instance")
+for role, content_type, fpath in STATIC_PATH.values():
+    static_asset(fpath, content_type)
+prewarm_worker = utils.worker.DebouncedWorker(prewarm, PREWARM_DELAY)
+update_queue = utils.worker.OrderedQueue(
+    process_update, update_failed, UPDATE_QUEUE_SIZE,
+    model.TRANSIENT_ERRORS, UPDATE_RETRIES
+)
+handle.LISTENERS.append(prewarm_worker.notify)
 auth_middleware = AuthMiddleware()
-app = falcon.API(middleware=auth_middleware)
+database_middleware = DatabaseMiddleware()
+app = falcon.API(middleware=[auth_middleware, database_middleware])
 app.add_error_handler(Exception, handler=handle_exception)
 
 role_resource = RoleResource()
 show_resource = ShowResource()
+metrics_resource = MetricsResource()
+bulk_resource = BulkResource()
 login_resource = LoginResource()
 telegram_resource = TelegramResource()
 ifttt_resource = IftttResource()
 
 app.add_route("/js/role", role_resource)
 app.add_route("/show/{name}", show_resource)
+app.add_route("/metrics", metrics_resource)
+app.add_route("/bulk/{kind}", bulk_resource)
 app.add_route("/login", login_resource)
 app.add_route(f"/{utils.telegram.TELEGRAM_TOKEN}", telegram_resource)
 app.add_route(f"/{IFTTT_TOKEN}", ifttt_resource)
@@ -1,12 +1,32 @@
 #! python3
+import datetime
 import os
 
 import peewee as pw
 import playhouse.db_url as db_url
 
 DATABASE_URL = os.environ["DATABASE_URL"]
+DATABASE_MAX_CONNECTIONS = int(os.environ.get("DATABASE_MAX_CONNECTIONS", 8))
+DATABASE_STALE_TIMEOUT = int(os.environ.get("DATABASE_STALE_TIMEOUT", 300))
+DATABASE_POOL_TIMEOUT = int(os.environ.get("DATABASE_POOL_TIMEOUT", 10))
 
-db = db_url.connect(DATABASE_URL, sslmode="require")
+TRANSIENT_ERRORS = (pw.OperationalError, pw.InterfaceError)  # Worth a retry
+
+
+def pooled_url(url):
+    """
+    Use the pooled variant of the database scheme (postgres+pool://...)
+    """
+    scheme, rest = url.split("://", 1)
+    if not scheme.endswith("+pool"):
+        scheme += "+pool"
+    return f"{scheme}://{rest}"
+
+
+db = db_url.connect(pooled_url(DATABASE_URL), sslmode="require",
+                    max_connections=DATABASE_MAX_CONNECTIONS,
+                    stale_timeout=DATABASE_STALE_TIMEOUT,
+                    timeout=DATABASE_POOL_TIMEOUT)
 
 
 class BaseModel(pw.Model):
@@ -30,23 +50,119 @@ class Birthday(BaseModel):
 
 
 class Period(BaseModel):
-    idate = pw.DateField()
-    fdate = pw.DateField()
+    idate = pw.DateField(index=True)
+    fdate = pw.DateField(index=True)
     text = pw.TextField()
 
 
+class WeekAggregate(BaseModel):
+    """
+    Sum, count, minimum and maximum of the amounts of a week, where week is
+    (date.toordinal() - 1) // 7 (weeks start on Monday)
+    """
+    kind = pw.TextField()  # Key of AMOUNT_MODELS
+    week = pw.IntegerField()
+    total = pw.IntegerField()
+    count = pw.SmallIntegerField()
+    minimum = pw.SmallIntegerField()
+    maximum = pw.SmallIntegerField()
+
+    class Meta:
+        primary_key = pw.CompositeKey("kind", "week")
+
+
 class State(BaseModel):
     name = pw.TextField(unique=True)
     state = pw.TextField()
     date = pw.DateTimeField()
 
 
+class Version(BaseModel):
+    """
+    Counter of the writes to the data behind a /show/{name} image, shared
+    by every process
+    """
+    name = pw.TextField(primary_key=True)
+    version = pw.IntegerField()
+
+
 class User(BaseModel):
     username = pw.TextField(unique=True)
     password = pw.TextField()
     role = pw.SmallIntegerField()
 
 
+AMOUNT_MODELS = {"sleep": Sleep, "out": Out}
+
+
+def refresh_week(kind, week):
+    """
+    Compute the aggregate of a week again from its (at most 7) rows.
+    Meant to be called inside the transaction that changed them
+    """
+    correct_model = AMOUNT_MODELS[kind]
+    monday = datetime.date.fromordinal(week * 7 + 1)
+    sunday = monday + datetime.timedelta(days=6)
+    total, count, minimum, maximum = (
+        correct_model
+        .select(pw.fn.SUM(correct_model.amount),
+                pw.fn.COUNT(correct_model.amount),
+                pw.fn.MIN(correct_model.amount),
+                pw.fn.MAX(correct_model.amount))
+        .where(correct_model.date.between(monday, sunday))
+        .tuples()
+        .get()
+    )
+    if not count:
+        WeekAggregate.delete().where(WeekAggregate.kind == kind,
+                                     WeekAggregate.week == week).execute()
+        return
+    values = {"total": total, "count": count,
+              "minimum": minimum, "maximum": maximum}
+    (WeekAggregate
+     .insert(kind=kind, week=week, **values)
+     .on_conflict(conflict_target=[WeekAggregate.kind, WeekAggregate.week],
+                  update=values)
+     .execute())
+
+
+def rebuild_aggregates():
+    """
+    Compute every week aggregate from scratch
+    """
+    with db.atomic():
+        WeekAggregate.delete().execute()
+        for kind, correct_model in AMOUNT_MODELS.items():
+            weeks = set((date.toordinal() - 1) // 7 for date, in
+                        correct_model.select(correct_model.date).tuples())
+            for week in weeks:
+                refresh_week(kind, week)
+
+
+def bump_version(name):
+    """
+    Mark the data behind a /show/{name} image as changed. Meant to be
+    called inside the transaction of the write
+    """
+    (Version
+     .insert(name=name, version=1)
+     .on_conflict(conflict_target=[Version.name],
+                  update={Version.version: Version.version + 1})
+     .execute())
+
+
+def data_version(name):
+    return (Version.select(Version.version)
+            .where(Version.name == name)
+            .scalar()) or 0
+
+
+def pool_metrics():
+    return {"in_use": len(db._in_use), "idle": len(db._connections),
+            "max": db._max_connections}
+
+
 def main():
     db.connect()
-    db.create_tables([Sleep, Out, Birthday, Period, State, User])
+    db.create_tables([Sleep, Out, Birthday, Period, WeekAggregate, State,
+                      Version, User])
@@ -0,0 +1,37 @@
+#! python3
+import argparse
+import sys
+
+import bulk
+import utils.log
+
+logger = utils.log.get("backfill")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Import or export sleep, out, birthday and period rows"
+    )
+    parser.add_argument("action", choices=("import", "export"))
+    parser.add_argument("kind", choices=tuple(bulk.FIELDS))
+    parser.add_argument("path", nargs="?", default="-",
+                        help="File to read or write, - for stdin/stdout")
+    parser.add_argument("--format", choices=tuple(bulk.CONTENT_TYPES),
+                        default="csv")
+    args = parser.parse_args()
+
+    if args.action == "import":
+        if args.path == "-":
+            f = sys.stdin
+        else:
+            f = open(args.path, newline="")
+        with f:
+            total = bulk.ingest(args.kind, args.format, f)
+        logger.warning(f"Imported {total} {args.kind} rows")
+    else:
+        if args.path == "-":
+            f = sys.stdout.buffer
+        else:
+            f = open(args.path, "wb")
+        with f:
+            for data in bulk.export(args.kind, args.format):
+                f.write(data)
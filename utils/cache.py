@@ -0,0 +1,164 @@
+#! python3
+import collections
+import hashlib
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+
+class LRUCache:
+    """
+    Thread safe mapping that evicts the least recently used entry once it
+    holds more than :attr:`maxsize` items
+
+    :param int maxsize: Maximum number of entries
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs a function only once for concurrent callers with the same key, the
+    rest wait for it and share its result (or exception)
+
+    If ``lock_dir`` is set, callers in other processes are coalesced too
+    using file locks. The function must then return bytes, which are kept
+    in ``lock_dir`` for ``ttl`` seconds for the processes that waited
+
+    :param str lock_dir: Directory shared by every process
+    :param float ttl: Seconds a shared result is valid
+    """
+
+    def __init__(self, lock_dir=None, ttl=60):
+        self.lock_dir = lock_dir
+        self.ttl = ttl
+        self.shared = 0  # Callers that did not have to run the function
+        self._calls = {}
+        self._lock = threading.Lock()
+        if lock_dir:
+            os.makedirs(lock_dir, exist_ok=True)
+
+    def do(self, key, function, *args, **kw):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            self.shared += 1
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            if self.lock_dir and fcntl is not None:
+                call.result = self._do_locked(key, function, args, kw)
+            else:
+                call.result = function(*args, **kw)
+        except Exception as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+    def _do_locked(self, key, function, args, kw):
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        path = os.path.join(self.lock_dir, name)
+        with open(path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    if time.time() - os.path.getmtime(path) < self.ttl:
+                        with open(path, "rb") as f:
+                            data = f.read()
+                        self.shared += 1
+                        return data
+                except OSError:
+                    pass  # Nobody has run it yet
+                data = function(*args, **kw)
+                self._prune()
+                with open(path + ".tmp", "wb") as f:
+                    f.write(data)
+                os.replace(path + ".tmp", path)
+                return data
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _prune(self):
+        now = time.time()
+        for entry in os.scandir(self.lock_dir):
+            if entry.name.endswith(".tmp"):
+                continue
+            try:
+                if now - entry.stat().st_mtime <= self.ttl:
+                    continue
+                if entry.name.endswith(".lock"):
+                    self._remove_lock(entry.path)
+                else:
+                    os.remove(entry.path)
+            except OSError:
+                pass  # Removed by another process
+
+    @staticmethod
+    def _remove_lock(path):
+        # Only if nobody holds it, at worst a key is computed twice
+        with open(path, "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return  # In use
+            try:
+                os.remove(path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
@@ -0,0 +1,122 @@
+#! python3
+import concurrent.futures
+import concurrent.futures.process
+import threading
+
+_initialized = False  # In a child process
+
+
+class Busy(Exception):
+    """
+    Raised when too many jobs are already waiting in an executor
+    """
+
+
+def _call(initializer, function, kw):
+    # ProcessPoolExecutor only takes an initializer since Python 3.7
+    global _initialized
+    if not _initialized:
+        _initialized = True
+        if initializer is not None:
+            initializer()
+    return function(**kw)
+
+
+class Executor:
+    """
+    Runs CPU bound jobs in a pool of processes, or inline in the calling
+    thread when ``processes`` is 0 (useful for tests and single core hosts)
+
+    :param int processes: Number of child processes, 0 for inline mode
+    :param int max_pending: Jobs allowed in flight before raising
+        :class:`Busy`
+    :param float timeout: Seconds to wait for a result
+    :param initializer: Called once in every child process, before its
+        first job
+    """
+
+    def __init__(self, processes=0, max_pending=8, timeout=30,
+                 initializer=None):
+        self.processes = processes
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.initializer = initializer
+        self.counters = {"submitted": 0, "completed": 0, "failed": 0,
+                         "rejected": 0, "timeouts": 0, "max_pending": 0}
+        self.pending = 0
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:  # Created lazily, after any fork
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    self.processes
+                )
+            return self._pool
+
+    def _reset_pool(self, pool):
+        # A child died, the next job starts a new pool
+        with self._lock:
+            if self._pool is pool:  # Not replaced by another thread yet
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    def _done(self, future=None):
+        with self._lock:
+            self.pending -= 1
+
+    def run(self, function, **kw):
+        """
+        Run ``function(**kw)`` and return its result
+
+        :raises Busy: If there are already too many jobs in flight
+        :raises concurrent.futures.TimeoutError: If it took too long
+        """
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.counters["rejected"] += 1
+                raise Busy(f"{self.pending} jobs in flight")
+            self.pending += 1
+            self.counters["submitted"] += 1
+            self.counters["max_pending"] = max(self.counters["max_pending"],
+                                               self.pending)
+        if not self.processes:
+            try:
+                result = function(**kw)
+            except Exception:
+                self.counters["failed"] += 1
+                raise
+            finally:
+                self._done()
+            self.counters["completed"] += 1
+            return result
+
+        pool = self._get_pool()
+        try:
+            future = pool.submit(_call, self.initializer, function, kw)
+        except Exception:
+            self._done()
+            self.counters["failed"] += 1
+            raise
+        # Freed when the child finishes, even after a timeout
+        future.add_done_callback(self._done)
+        try:
+            result = future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            self.counters["timeouts"] += 1
+            raise
+        except concurrent.futures.process.BrokenProcessPool:
+            self._reset_pool(pool)
+            self.counters["failed"] += 1
+            raise
+        except Exception:
+            self.counters["failed"] += 1
+            raise
+        self.counters["completed"] += 1
+        return result
+
+    def metrics(self):
+        return dict(self.counters, pending=self.pending,
+                    processes=self.processes)
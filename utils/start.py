@@ -12,3 +12,6 @@ if __name__ == "__main__":
 
     logger.warning("Creating database")
     model.main()
+
+    logger.warning("Computing week aggregates")
+    model.rebuild_aggregates()
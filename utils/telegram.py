@@ -1,33 +1,161 @@
 #! python3
+import contextlib
+import http.client
 import json
 import logging
 import os
+import queue
+import threading
+import time
 import urllib.parse
-import urllib.request
 
 APPNAME = os.environ["APPNAME"]
 BOT_ID = int(os.environ["TELEGRAM_BOT_ID"])
 MY_ID = int(os.environ["TELEGRAM_PERSONAL_ID"])
 TELEGRAM_TOKEN = os.environ["TELEGRAM_TOKEN"]
+# Can point to a local stand-in server, e.g. http://localhost:8081
+API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org")
+TIMEOUT = float(os.environ.get("TELEGRAM_TIMEOUT", 10))
+POOL_SIZE = 4  # Idle connections kept open
+RETRIES = 3  # When rate limited or the connection was closed
+CHAT_INTERVAL = 1  # Minimum seconds between messages to the same chat
 URL = f"https://{APPNAME}.herokuapp.com/{TELEGRAM_TOKEN}"
 logger = logging.getLogger("Telegram")
 
 
+class TelegramError(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP(S) connections to a single host, reused between calls
+    so the TLS handshake is only paid once per connection
+
+    :param str url: Base URL, only the scheme and host are used
+    :param float timeout: Socket timeout in seconds
+    :param int size: Idle connections kept open
+    """
+
+    def __init__(self, url, timeout=TIMEOUT, size=POOL_SIZE):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme == "https":
+            self.connection_class = http.client.HTTPSConnection
+        else:
+            self.connection_class = http.client.HTTPConnection
+        self.host = parts.netloc
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(size)
+
+    def _get(self):
+        """
+        :return: A connection and whether it was idle in the pool
+        :rtype: tuple(http.client.HTTPConnection, bool)
+        """
+        try:
+            return self._idle.get_nowait(), True
+        except queue.Empty:
+            return (self.connection_class(self.host, timeout=self.timeout),
+                    False)
+
+    def _put(self, connection):
+        try:
+            self._idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def post(self, path, body, headers):
+        """
+        :return: Response status and body
+        :rtype: tuple(int, bytes)
+        """
+        while True:
+            connection, reused = self._get()
+            try:
+                connection.request("POST", path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError) as ex:
+                connection.close()
+                # Only an idle connection closed by the server is retried,
+                # after a timeout the request may have been handled already
+                if reused and isinstance(ex, ConnectionError):
+                    continue
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._put(connection)
+            return response.status, data
+
+
 class Bot:
-    def __init__(self, token=TELEGRAM_TOKEN):
-        self.url = f"https://api.telegram.org/bot{token}/"
+    def __init__(self, token=TELEGRAM_TOKEN, api_url=API_URL):
+        base_path = urllib.parse.urlsplit(api_url).path.rstrip("/")
+        self.path = f"{base_path}/bot{token}/"
+        self.pool = ConnectionPool(api_url)
+        self._last_sent = {}  # chat_id -> time.monotonic()
+        self._local = threading.local()
 
     def call(self, method, **kw):
         data = urllib.parse.urlencode(kw).encode()
-        r = urllib.request.urlopen(self.url + method, data=data).read()
-        return json.loads(r)
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        for attempt in range(RETRIES + 1):
+            status, body = self.pool.post(self.path + method, data, headers)
+            try:
+                r = json.loads(body)
+            except ValueError:
+                raise TelegramError(f"{method} -> {status}: {body[:100]}")
+            if status != 429 or attempt == RETRIES:
+                break
+            retry_after = r.get("parameters", {}).get("retry_after", 1)
+            logger.warning(f"Rate limited, retrying in {retry_after}s")
+            time.sleep(retry_after)
+        if not r.get("ok"):
+            raise TelegramError(f"{method} -> {r.get('description')}")
+        return r
+
+    def _throttle(self, chat_id):
+        wait = self._last_sent.get(chat_id, 0) + CHAT_INTERVAL
+        now = time.monotonic()
+        if wait > now:
+            time.sleep(wait - now)
+        self._last_sent[chat_id] = time.monotonic()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Join every :meth:`report` done inside the block (in this thread)
+        into a single message sent when the block ends. If the block raises
+        they are dropped, what they reported may have been rolled back (and
+        retried) and the error is reported by the caller
+        """
+        if getattr(self._local, "reports", None) is not None:  # Nested
+            yield
+            return
+        self._local.reports = []
+        try:
+            yield
+        finally:
+            reports, self._local.reports = self._local.reports, None
+        if reports:
+            try:
+                self.send_message(MY_ID, "\n".join(reports),
+                                  disable_notification=True)
+            except Exception as ex:  # The block succeeded, do not fail it now
+                logger.exception(ex)
 
     def forward_message(self, chat_id, from_chat_id, message_id):
+        self._throttle(chat_id)
         return self.call("forwardMessage", chat_id=chat_id,
                          from_chat_id=from_chat_id, message_id=message_id)
 
     def report(self, text, **kw):
         logger.info(text)
+        reports = getattr(self._local, "reports", None)
+        if reports is not None and not kw:
+            reports.append(text)
+            return None
         return self.send_message(MY_ID, text, disable_notification=True, **kw)
 
     def set_webhook(self, url=URL):
@@ -35,6 +163,7 @@ class Bot:
         return self.call("setWebhook", url=url)
 
     def send_message(self, chat_id, text, **kw):
+        self._throttle(chat_id)
         return self.call("sendMessage", chat_id=chat_id, text=text,
                          parse_mode="Markdown", **kw)
 
@@ -0,0 +1,143 @@
+#! python3
+import collections
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger("Worker")
+
+
+class DebouncedWorker:
+    """
+    Background thread that calls ``callback`` with the set of keys notified
+    once no new notification has arrived for ``delay`` seconds, so a burst
+    of notifications results in a single call
+
+    :param callback: Function receiving a set of keys
+    :param float delay: Seconds of quiet to wait for
+    """
+
+    def __init__(self, callback, delay=1.0):
+        self.callback = callback
+        self.delay = delay
+        self._pending = set()
+        self._last = 0
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def notify(self, key):
+        with self._condition:
+            self._pending.add(key)
+            self._last = time.monotonic()
+            if self._thread is None:  # Started lazily, after any fork
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                remaining = self.delay
+                while remaining > 0:
+                    self._condition.wait(remaining)
+                    remaining = self._last + self.delay - time.monotonic()
+                keys, self._pending = self._pending, set()
+            try:
+                self.callback(keys)
+            except Exception as ex:
+                logger.exception(ex)
+
+
+class OrderedQueue:
+    """
+    Bounded queue processed in order by a background thread. Items whose id
+    was already queued are dropped and items failing with one of
+    ``retry_on`` are tried again with exponential backoff
+
+    :param callback: Function receiving every item
+    :param on_error: Function receiving the item and the exception when it
+        finally fails
+    :param int maxsize: Items waiting before :meth:`put` refuses more
+    :param tuple retry_on: Exception types worth retrying
+    :param int retries: Attempts after the first one
+    :param float backoff: Seconds waited before the first retry
+    :param int remember: Ids kept to detect duplicates
+    """
+
+    def __init__(self, callback, on_error=None, maxsize=100, retry_on=(),
+                 retries=3, backoff=1.0, remember=1000):
+        self.callback = callback
+        self.on_error = on_error
+        self.retry_on = retry_on
+        self.retries = retries
+        self.backoff = backoff
+        self.remember = remember
+        self.counters = {"queued": 0, "duplicated": 0, "rejected": 0,
+                         "retried": 0, "failed": 0}
+        self._queue = queue.Queue(maxsize)
+        self._seen = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def put(self, item, item_id=None):
+        """
+        Queue an item
+
+        :return: False if the queue is full, True otherwise
+        :rtype: bool
+        """
+        with self._lock:
+            if item_id is not None and item_id in self._seen:
+                self.counters["duplicated"] += 1
+                return True
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self.counters["rejected"] += 1
+                return False
+            self.counters["queued"] += 1
+            if item_id is not None:
+                self._seen[item_id] = None
+                while len(self._seen) > self.remember:
+                    self._seen.popitem(last=False)
+            if self._thread is None:  # Started lazily, after any fork
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return True
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            delay = self.backoff
+            for attempt in range(self.retries + 1):
+                try:
+                    self.callback(item)
+                except self.retry_on as ex:
+                    if attempt == self.retries:
+                        self._fail(item, ex)
+                        break
+                    logger.warning(f"Retrying in {delay}s: {ex}")
+                    self.counters["retried"] += 1
+                    time.sleep(delay)
+                    delay *= 2
+                except Exception as ex:
+                    self._fail(item, ex)
+                    break
+                else:
+                    break
+            self._queue.task_done()
+
+    def _fail(self, item, ex):
+        self.counters["failed"] += 1
+        logger.exception(ex)
+        if self.on_error is not None:
+            try:
+                self.on_error(item, ex)
+            except Exception as error:
+                logger.exception(error)
+
+    def join(self):
+        self._queue.join()